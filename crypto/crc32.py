@@ -1,10 +1,26 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 """Calculate and manipulate CRC32.
 http://en.wikipedia.org/wiki/Cyclic_redundancy_check
 -- StalkR
+
+Use new() for a hashlib-like object fed with update(), and file_digest() to
+checksum a file in constant memory. Use combine() to get the crc32 of two
+pieces from their crc32, and calc_parallel() to checksum a file with a pool
+of processes.
 """
+import argparse
+import concurrent.futures
+import mmap
+import os
 import struct
 import sys
+import zlib
+
+try:
+  # Optional native CRC-32C (https://pypi.org/project/crc32c/).
+  from crc32c import crc32c as native_crc32c
+except ImportError:
+  native_crc32c = None
 
 # Polynoms in reversed notation
 POLYNOMS = {
@@ -14,6 +30,15 @@ POLYNOMS = {
   'CRC-32Q': 0xD5828281,
 }
 
+# Slice-by-8 tables by polynom, built on first use, see _slice_tables.
+_SLICE_TABLES = {}
+
+# CRC32 instance by type, shared by hash objects, see engine().
+_ENGINES = {}
+
+# Size of chunks read from files.
+CHUNK_SIZE = 1 << 20
+
 class Error(Exception):
   pass
 
@@ -23,6 +48,9 @@ class CRC32(object):
   Use one instance per type of polynom you want to use.
   Use calc() to calculate a crc32.
   Use forge() to forge crc32 by adding 4 bytes anywhere.
+
+  Input is processed 8 bytes per step (slice-by-8). CRC-32-IEEE is delegated
+  to zlib, CRC-32C to the crc32c module when available.
   """
   def __init__(self, type="CRC-32-IEEE"):
     if type not in POLYNOMS:
@@ -30,6 +58,13 @@ class CRC32(object):
     self.polynom = POLYNOMS[type]
     self.table, self.reverse = [0]*256, [0]*256
     self._build_tables()
+    # _zeros[k] is the GF(2) operator appending 2^k zero bytes, see combine.
+    self._zeros = []
+    self.native = None
+    if type == 'CRC-32-IEEE':
+      self.native = zlib.crc32
+    elif type == 'CRC-32C':
+      self.native = native_crc32c
 
   def _build_tables(self):
     for i in range(256):
@@ -50,14 +85,44 @@ class CRC32(object):
         rev &= 0xffffffff
         self.reverse[i] = rev
 
+  def _slice_tables(self):
+    """Return the 8 tables of slice-by-8, tables[k][i] is the crc of byte i
+    followed by k zero bytes."""
+    tables = _SLICE_TABLES.get(self.polynom)
+    if tables is None:
+      tables = [self.table]
+      for k in range(1, 8):
+        tables.append([(c >> 8) ^ self.table[c & 0xff] for c in tables[k-1]])
+      _SLICE_TABLES[self.polynom] = tables
+    return tables
+
+  def extend(self, crc, s):
+    """Calculate crc32 of bytes s following bytes whose crc32 is crc.
+    Same as binascii.crc32(s, crc)&0xffffffff.
+    """
+    if self.native is not None:
+      return self.native(s, crc) & 0xffffffff
+    buf = memoryview(s).cast('B')
+    n8 = len(buf) & ~7
+    crc ^= 0xffffffff
+    if n8:
+      t0, t1, t2, t3, t4, t5, t6, t7 = self._slice_tables()
+      for lo, hi in struct.iter_unpack('<II', buf[:n8]):
+        crc ^= lo
+        crc = (t7[crc & 0xff] ^ t6[(crc >> 8) & 0xff] ^
+               t5[(crc >> 16) & 0xff] ^ t4[crc >> 24] ^
+               t3[hi & 0xff] ^ t2[(hi >> 8) & 0xff] ^
+               t1[(hi >> 16) & 0xff] ^ t0[hi >> 24])
+    table = self.table
+    for c in buf[n8:]:
+      crc = (crc >> 8) ^ table[(crc ^ c) & 0xff]
+    return crc^0xffffffff
+
   def calc(self, s):
-    """Calculate crc32 of a string.
+    """Calculate crc32 of bytes.
     Same crc32 as in (binascii.crc32)&0xffffffff.
     """
-    crc = 0xffffffff
-    for c in s:
-      crc = (crc >> 8) ^ self.table[(crc ^ ord(c)) & 0xff]
-    return crc^0xffffffff
+    return self.extend(0, s)
 
   def forge(self, wanted_crc, s, pos=None):
     """Forge crc32 of a string by adding 4 bytes at position pos."""
@@ -65,33 +130,198 @@ class CRC32(object):
       pos = len(s)
     
     # forward calculation of CRC up to pos, sets current forward CRC state
-    fwd_crc = 0xffffffff
-    for c in s[:pos]:
-      fwd_crc = (fwd_crc >> 8) ^ self.table[(fwd_crc ^ ord(c)) & 0xff]
+    fwd_crc = self.calc(s[:pos])^0xffffffff
     
     # backward calculation of CRC up to pos, sets wanted backward CRC state
     bkd_crc = wanted_crc^0xffffffff
     for c in s[pos:][::-1]:
-      bkd_crc = ((bkd_crc << 8)&0xffffffff) ^ self.reverse[bkd_crc >> 24] ^ ord(c)
+      bkd_crc = ((bkd_crc << 8)&0xffffffff) ^ self.reverse[bkd_crc >> 24] ^ c
     
     # deduce the 4 bytes we need to insert
     for c in struct.pack('<L',fwd_crc)[::-1]:
-      bkd_crc = ((bkd_crc << 8)&0xffffffff) ^ self.reverse[bkd_crc >> 24] ^ ord(c)
+      bkd_crc = ((bkd_crc << 8)&0xffffffff) ^ self.reverse[bkd_crc >> 24] ^ c
     
     res = s[:pos] + struct.pack('<L', bkd_crc) + s[pos:]
-    assert(crc32(res) == wanted_crc)
+    assert(self.calc(res) == wanted_crc)
     return res
 
+  def _zeros_operator(self, k):
+    """Return the 32x32 GF(2) matrix (a list of 32 columns) applied to the
+    crc register when 2^k zero bytes are processed."""
+    if not self._zeros:
+      # one zero bit: shift right, xor polynom if the low bit was set
+      op = [self.polynom] + [1 << n for n in range(31)]
+      for _ in range(3):
+        op = _gf2_square(op)
+      self._zeros.append(op)
+    while len(self._zeros) <= k:
+      self._zeros.append(_gf2_square(self._zeros[-1]))
+    return self._zeros[k]
+
+  def combine(self, crc_a, crc_b, len_b):
+    """Calculate crc32 of a+b from crc32 of a, crc32 of b and length of b.
+    Same as zlib crc32_combine, in O(log(len_b)).
+    """
+    k = 0
+    while len_b > 0:
+      if len_b & 1:
+        crc_a = _gf2_times(self._zeros_operator(k), crc_a)
+      len_b >>= 1
+      k += 1
+    return crc_a ^ crc_b
+
+def _gf2_times(mat, vec):
+  """Multiply a 32x32 GF(2) matrix by a vector."""
+  s = 0
+  i = 0
+  while vec:
+    if vec & 1:
+      s ^= mat[i]
+    vec >>= 1
+    i += 1
+  return s
+
+def _gf2_square(mat):
+  return [_gf2_times(mat, col) for col in mat]
+
+def engine(type="CRC-32-IEEE"):
+  """Return the shared CRC32 instance of a type of polynom."""
+  if type not in _ENGINES:
+    _ENGINES[type] = CRC32(type)
+  return _ENGINES[type]
+
+class Hash(object):
+  """Incremental crc32 with the interface of hashlib objects.
+
+  The digest is the crc32 in big endian, as printed by hexdigest(). The crc32
+  as an integer is in the crc attribute.
+  """
+  digest_size = 4
+  block_size = 1
+
+  def __init__(self, type="CRC-32-IEEE", data=b''):
+    self.name = type
+    self._engine = engine(type)
+    self.crc = 0
+    if data:
+      self.update(data)
+
+  def update(self, data):
+    """Add bytes or any buffer (bytearray, memoryview, mmap)."""
+    self.crc = self._engine.extend(self.crc, data)
+
+  def digest(self):
+    return struct.pack('>L', self.crc)
+
+  def hexdigest(self):
+    return '%08x' % self.crc
+
+  def copy(self):
+    h = Hash(self.name)
+    h.crc = self.crc
+    return h
+
+def new(type="CRC-32-IEEE", data=b''):
+  """Return a new Hash object, like hashlib.new()."""
+  return Hash(type, data)
+
+def _read_into(h, f, length=None):
+  """Update Hash h with the rest of binary file f, or its next length bytes,
+  in CHUNK_SIZE chunks read into one buffer."""
+  buf = bytearray(CHUNK_SIZE)
+  view = memoryview(buf)
+  while length is None or length > 0:
+    want = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length)
+    n = f.readinto(view[:want])
+    if not n:
+      break
+    h.update(view[:n])
+    if length is not None:
+      length -= n
+
+def file_digest(path, type="CRC-32-IEEE", use_mmap=False):
+  """Return the Hash of a file, read in chunks or mapped in memory 64 chunks
+  at a time with use_mmap."""
+  h = Hash(type)
+  with open(path, 'rb', buffering=0) as f:
+    if not use_mmap:
+      _read_into(h, f)
+      return h
+    size = f.seek(0, 2)
+    for offset in range(0, size, CHUNK_SIZE * 64):
+      length = min(CHUNK_SIZE * 64, size - offset)
+      with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ,
+                     offset=offset) as m:
+        h.update(m)
+  return h
+
+def combine(crc_a, crc_b, len_b, type="CRC-32-IEEE"):
+  """Return crc32 of a+b from crc32 of a, crc32 of b and length of b."""
+  return engine(type).combine(crc_a, crc_b, len_b)
+
+def _segment_crc(path, type, offset, length):
+  h = Hash(type)
+  with open(path, 'rb', buffering=0) as f:
+    f.seek(offset)
+    _read_into(h, f, length)
+  return h.crc
+
+def calc_parallel(path, workers=None, type="CRC-32-IEEE"):
+  """Calculate crc32 of a file, split in one segment per worker process,
+  from the crc32 of its segments."""
+  workers = workers or os.cpu_count()
+  size = os.path.getsize(path)
+  segment = max(CHUNK_SIZE, -(-size // workers))
+  offsets = range(0, size, segment)
+  lengths = [min(segment, size - offset) for offset in offsets]
+  if len(lengths) < 2:
+    return file_digest(path, type).crc
+  with concurrent.futures.ProcessPoolExecutor(len(lengths)) as pool:
+    crcs = pool.map(_segment_crc, [path] * len(lengths), [type] * len(lengths),
+                    offsets, lengths)
+    crc = 0
+    for segment_crc, length in zip(crcs, lengths):
+      crc = combine(crc, segment_crc, length, type)
+  return crc
+
+def main():
+  parser = argparse.ArgumentParser(description='Calculate CRC32.')
+  parser.add_argument('args', nargs='*', metavar='STRING|FILE',
+                      help='strings, or files with -f (default: test)')
+  parser.add_argument('-t', '--type', choices=sorted(POLYNOMS),
+                      default='CRC-32-IEEE',
+                      help='polynom (default: %(default)s)')
+  parser.add_argument('-f', '--file', action='store_true',
+                      help='checksum files, - for stdin')
+  parser.add_argument('--mmap', action='store_true',
+                      help='map files in memory instead of reading them')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                      help='checksum segments of files in N processes '
+                           '(0: number of CPUs)')
+  args = parser.parse_args()
+
+  if args.file:
+    for path in args.args:
+      if path == '-':
+        h = new(args.type)
+        _read_into(h, sys.stdin.buffer)
+      elif args.jobs is not None:
+        h = new(args.type)
+        h.crc = calc_parallel(path, args.jobs, args.type)
+      else:
+        h = file_digest(path, args.type, args.mmap)
+      print('%s  %s' % (h.hexdigest(), path))
+    return
+
+  for arg in args.args or ['test']:
+    crc = new(args.type, arg.encode()).crc
+    name = 'CRC32' if args.type == 'CRC-32-IEEE' else args.type
+    print("%s(%s) = 0x%08x" % (name, arg, crc))
+
+    # check with library
+    if args.type == 'CRC-32-IEEE':
+      from binascii import crc32
+      assert(crc == crc32(arg.encode())&0xffffffff)
+
 if __name__=='__main__':
-  if len(sys.argv) > 1:
-    arg = sys.argv[1]
-  else:
-    arg = "test"
-  
-  # CRC32 with default polynom
-  crc = CRC32().calc(arg)
-  print "CRC32(%s) = 0x%08x" % (arg, crc)
-  
-  # check with library
-  from binascii import crc32
-  assert(crc == crc32(arg)&0xffffffff)
+  main()
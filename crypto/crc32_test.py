@@ -0,0 +1,181 @@
+"""Unit tests for crc32.py."""
+
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import crc32
+
+# crc32 of '123456789' (the usual check value) and of a pangram.
+VECTORS = {
+  'CRC-32-IEEE': (0xcbf43926, 0x414fa339),
+  'CRC-32C': (0xe3069283, 0x22620404),
+  'CRC-32K': (0x2d3dd0ae, 0xe021db90),
+  'CRC-32Q': (0xa9cc8179, 0x6a001b25),
+}
+PANGRAM = b'The quick brown fox jumps over the lazy dog'
+
+
+def engines(type):
+  """Return the CRC32 engines to test for a type: native if any, and pure
+  python slice-by-8."""
+  native = crc32.CRC32(type)
+  pure = crc32.CRC32(type)
+  pure.native = None
+  return [native, pure] if native.native else [pure]
+
+
+def bitwise(type, data):
+  """Reference crc32, one bit at a time."""
+  crc = 0xffffffff
+  for c in data:
+    crc ^= c
+    for _ in range(8):
+      crc = (crc >> 1) ^ (crc32.POLYNOMS[type] if crc & 1 else 0)
+  return crc ^ 0xffffffff
+
+
+class TestCalc(unittest.TestCase):
+
+  def testVectors(self):
+    for type, (check, pangram) in VECTORS.items():
+      for engine in engines(type):
+        self.assertEqual(engine.calc(b'123456789'), check, type)
+        self.assertEqual(engine.calc(PANGRAM), pangram, type)
+        self.assertEqual(engine.calc(b''), 0, type)
+
+  def testSliceBy8(self):
+    data = os.urandom(1000)
+    for type in crc32.POLYNOMS:
+      engine = engines(type)[-1]
+      for n in (1, 7, 8, 9, 15, 16, 17, 1000):
+        self.assertEqual(engine.calc(data[:n]), bitwise(type, data[:n]),
+                         '%s len %d' % (type, n))
+      self.assertEqual(engine.calc(memoryview(bytearray(data))),
+                       bitwise(type, data))
+
+  def testNative(self):
+    data = os.urandom(1000)
+    self.assertEqual(crc32.CRC32().calc(data), zlib.crc32(data))
+    if crc32.native_crc32c is None:
+      self.skipTest('crc32c module not installed')
+    pure = engines('CRC-32C')[-1]
+    self.assertEqual(crc32.CRC32('CRC-32C').calc(data), pure.calc(data))
+
+  def testExtend(self):
+    data = os.urandom(1000)
+    for type in crc32.POLYNOMS:
+      for engine in engines(type):
+        n = random.randint(0, len(data))
+        self.assertEqual(engine.extend(engine.calc(data[:n]), data[n:]),
+                         engine.calc(data), type)
+
+  def testForge(self):
+    data = os.urandom(100)
+    for type in crc32.POLYNOMS:
+      for engine in engines(type):
+        for pos in (None, 0, 50):
+          forged = engine.forge(0xdeadbeef, data, pos)
+          self.assertEqual(len(forged), len(data) + 4)
+          self.assertEqual(engine.calc(forged), 0xdeadbeef, type)
+          pos = len(data) if pos is None else pos
+          self.assertEqual(forged[:pos] + forged[pos+4:], data)
+
+  def testUnknownPolynom(self):
+    with self.assertRaises(crc32.Error):
+      crc32.CRC32('CRC-31')
+
+
+class TestHash(unittest.TestCase):
+
+  def testUpdate(self):
+    for type, (check, _) in VECTORS.items():
+      h = crc32.new(type)
+      for c in b'123456789':
+        h.update(bytes([c]))
+      self.assertEqual(h.crc, check)
+      self.assertEqual(h.hexdigest(), '%08x' % check)
+      self.assertEqual(h.digest(), check.to_bytes(4, 'big'))
+      self.assertEqual(h.name, type)
+      self.assertEqual(h.digest_size, 4)
+      self.assertEqual(crc32.new(type, b'123456789').crc, check)
+
+  def testBuffers(self):
+    data = os.urandom(1000)
+    want = zlib.crc32(data)
+    for buf in (bytearray(data), memoryview(data), memoryview(data)[::1]):
+      self.assertEqual(crc32.new(data=buf).crc, want)
+
+  def testCopy(self):
+    h = crc32.new(data=b'1234')
+    c = h.copy()
+    c.update(b'56789')
+    self.assertEqual(h.crc, zlib.crc32(b'1234'))
+    self.assertEqual(c.crc, VECTORS['CRC-32-IEEE'][0])
+
+
+class TestCombine(unittest.TestCase):
+
+  def testCombine(self):
+    for type in crc32.POLYNOMS:
+      engine = crc32.CRC32(type)
+      for len_a, len_b in ((0, 0), (0, 10), (10, 0), (1, 1), (100, 1000),
+                           (3, 12345)):
+        a, b = os.urandom(len_a), os.urandom(len_b)
+        got = crc32.combine(engine.calc(a), engine.calc(b), len_b, type)
+        self.assertEqual(got, engine.calc(a + b),
+                         '%s %d+%d' % (type, len_a, len_b))
+
+  def testZlib(self):
+    a, b = os.urandom(100), os.urandom(1 << 16)
+    self.assertEqual(crc32.combine(zlib.crc32(a), zlib.crc32(b), len(b)),
+                     zlib.crc32(a + b))
+
+
+class TestFile(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.chunk_size = crc32.CHUNK_SIZE
+    # Small chunks so that files span many chunks and mmap windows.
+    crc32.CHUNK_SIZE = 1 << 12
+    self.data = os.urandom(5 * crc32.CHUNK_SIZE * 64 + 123)
+    self.path = os.path.join(self.dir, 'data')
+    with open(self.path, 'wb') as f:
+      f.write(self.data)
+
+  def tearDown(self):
+    crc32.CHUNK_SIZE = self.chunk_size
+    shutil.rmtree(self.dir)
+
+  def testFileDigest(self):
+    for type in crc32.POLYNOMS:
+      want = crc32.CRC32(type).calc(self.data)
+      for use_mmap in (False, True):
+        got = crc32.file_digest(self.path, type, use_mmap).crc
+        self.assertEqual(got, want, '%s mmap=%s' % (type, use_mmap))
+    with open(self.path, 'rb') as f:
+      h = hashlib.file_digest(f, lambda: crc32.new('CRC-32K'))
+    self.assertEqual(h.crc, crc32.CRC32('CRC-32K').calc(self.data))
+
+  def testEmpty(self):
+    path = os.path.join(self.dir, 'empty')
+    open(path, 'wb').close()
+    for use_mmap in (False, True):
+      self.assertEqual(crc32.file_digest(path, use_mmap=use_mmap).crc, 0)
+    self.assertEqual(crc32.calc_parallel(path, 4), 0)
+
+  def testParallel(self):
+    for type in ('CRC-32-IEEE', 'CRC-32Q'):
+      want = crc32.CRC32(type).calc(self.data)
+      for workers in (1, 3, 7):
+        self.assertEqual(crc32.calc_parallel(self.path, workers, type), want,
+                         '%s workers=%d' % (type, workers))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,5 @@
-#!/usr/bin/python
-"""Find duplicate files.
+#!/usr/bin/python3
+r"""Find duplicate files.
 
 Other programs doing this:
 1) fdupes: http://premium.caribe.net/~adrian2/fdupes.html
@@ -8,28 +8,58 @@ Other programs doing this:
    under optimized, compare files 2 by 2 (read same file multiple times)
 
 The algorithm here tries to be efficient in disk reads and comparisons:
-1) list files (ignore symlink)
-2) easy triage with stat operation:
-    - files with same path, same dev+inode are duplicates
+1) list files (ignore symlink) with concurrent scandir, one stat per file
+2) easy triage with stat operation, linear in the number of files:
+    - files with same dev+inode (hardlinks) are duplicates, read only once
     - files with different sizes are not duplicates
-3) find duplicates by working on a list of disjoint set of files, reading
-   by blocks, hashing, comparing all hashes then blocks if necessary
+3) find duplicates in same-size files with progressive hashing (BLAKE2b),
+   splitting groups at each stage: first 4 KiB, last 4 KiB, whole file;
+   most non-duplicates are ruled out without reading them entirely; each
+   stage hashes all candidates at once, optionally in a pool of processes
+   fed by one I/O queue per device
+4) optionally keep hashes in a persistent cache so unchanged files are not
+   read again on the next run
 
 Usage:
-  $ python dupes.py <path> [min size]
+  $ python dupes.py <path> [min size] [--cache PATH] [--jobs N]
   prints progress and a nice report
   $ python dupes.py <path> [min size] 2>/dev/null
   only prints duplicate files, one per line
+  $ python dupes.py <path> --exclude '*.tmp' --exclude 're:/\.git/' \
+      --min-size 1M --max-size 4G --one-file-system
+  skips matching files and directories while walking
+  $ python dupes.py <path> --format jsonl|csv|null0
+  streams each set of duplicates as soon as it is found
+  $ python dupes.py <path> --link hardlink|reflink|dry-run
+  replaces duplicates by links as soon as they are found
+  $ python dupes.py <path> --stats stats.json
+  writes time, files and bytes read per phase, and bytes skipped
 """
 
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import errno
+import fcntl
+import fnmatch
 import hashlib
-import itertools
+import io
+import json
+import mmap
 import os
+import queue
+import re
+import resource
+import shutil
+import sqlite3
 import sys
+import threading
+import time
 
 
 class ProgressClock(object):
-  """Simple progress class showing a turning bar /-\|."""
+  r"""Simple progress class showing a turning bar /-\|."""
 
   def __init__(self, message, fp=sys.stderr):
     self.fp = fp
@@ -62,7 +92,7 @@ class ProgressPercent(object):
     self.previous = 0
 
   def Tick(self):
-    percent = 100*self.i/self.total
+    percent = 100*self.i//self.total
     if percent != self.previous:
       self.fp.write('\b\b\b\b%3i%%' % percent)
       self.previous = percent
@@ -72,12 +102,71 @@ class ProgressPercent(object):
     self.fp.write('\b\b\b\b    \n')
 
 
+class Stats(object):
+  """Collects per phase wall time, files and bytes read, and the bytes that
+  did not have to be read.
+
+  Phases may nest, the time of a phase excludes the time of nested ones so
+  that phase times add up to the total."""
+
+  def __init__(self):
+    self.start = time.monotonic()
+    self.phases = {}  # name: {'seconds', 'files', 'bytes_read'}
+    self.skipped = {'triage': 0, 'partial': 0, 'cache': 0}
+    self._stack = []  # [start, nested seconds] of running phases.
+
+  def _Get(self, name):
+    return self.phases.setdefault(
+        name, {'seconds': 0.0, 'files': 0, 'bytes_read': 0})
+
+  @contextlib.contextmanager
+  def Phase(self, name):
+    phase = self._Get(name)
+    running = [time.monotonic(), 0.0]
+    self._stack.append(running)
+    try:
+      yield
+    finally:
+      self._stack.pop()
+      elapsed = time.monotonic() - running[0]
+      phase['seconds'] += elapsed - running[1]
+      if self._stack:
+        self._stack[-1][1] += elapsed
+
+  def Count(self, name, files=1, bytes_read=0):
+    phase = self._Get(name)
+    phase['files'] += files
+    phase['bytes_read'] += bytes_read
+
+  def Skip(self, reason, size):
+    self.skipped[reason] += size
+
+  def Summary(self):
+    phases = {}
+    for name, phase in self.phases.items():
+      seconds = max(phase['seconds'], 1e-9)
+      phases[name] = dict(
+          phase, seconds=round(phase['seconds'], 3),
+          files_per_s=round(phase['files'] / seconds, 1),
+          mb_per_s=round(phase['bytes_read'] / seconds / 1e6, 3))
+    return {
+      'seconds': round(time.monotonic() - self.start, 3),
+      'phases': phases,
+      'bytes_read': sum(phase['bytes_read'] for phase in self.phases.values()),
+      'bytes_skipped': dict(self.skipped),
+    }
+
+
+# Statistics of this run, see Stats.
+stats = Stats()
+
+
 class File(object):
   """File representation with helper for stat and comparison."""
 
-  def __init__(self, path):
+  def __init__(self, path, stat=None):
     self.path = path
-    self._stat = None
+    self._stat = stat
 
   @property
   def stat(self):
@@ -93,12 +182,19 @@ class File(object):
   def size(self):
     return self.stat.st_size
 
+  @property
+  def mtime_ns(self):
+    return self.stat.st_mtime_ns
+
   def ObviousDuplicate(self, file2):
     return self.path == file2.path or self.dev_inode == file2.dev_inode
 
   def PotentialDuplicate(self, file2):
     return self.size == file2.size
 
+  def __hash__(self):
+    return hash(self.path)
+
   def __eq__(self, other):
     return self.path == other.path
 
@@ -118,127 +214,896 @@ class File(object):
     return self.path >= other.path
 
 
-def ListFiles(path):
-  """Return list of files in a path, ignoring symlinks."""
+SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def ParseSize(value):
+  """Parse a size in bytes with an optional unit suffix: 10k, 1.5M, 2GiB."""
+  m = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([kmgt]?)(?:i?b)?\s*$', value, re.I)
+  if not m:
+    raise argparse.ArgumentTypeError('invalid size: %r' % value)
+  return int(float(m.group(1)) * SIZE_UNITS[m.group(2).lower()])
+
+
+class Filter(object):
+  r"""Decides during the walk which entries are kept.
+
+  Excludes are globs matched against the name or the path of an entry, or
+  regular expressions searched in the path if prefixed with 're:'. The path
+  of a directory ends with a separator, so 're:/\.git/' excludes .git
+  itself. Excluded directories are not scanned. If dev is given,
+  directories on another device are not scanned either. Files outside
+  [min_size, max_size] are dropped."""
+
+  def __init__(self, excludes=(), min_size=0, max_size=None, dev=None):
+    self.globs = [e for e in excludes if not e.startswith('re:')]
+    self.regexps = [re.compile(e[3:]) for e in excludes if e.startswith('re:')]
+    self.min_size = min_size
+    self.max_size = max_size
+    self.dev = dev
+
+  def Excluded(self, entry, is_dir=False):
+    path = entry.path + os.sep if is_dir else entry.path
+    for glob in self.globs:
+      if fnmatch.fnmatch(entry.name, glob) or fnmatch.fnmatch(path, glob):
+        return True
+    return any(r.search(path) for r in self.regexps)
+
+  def KeepDir(self, entry):
+    if self.Excluded(entry, is_dir=True):
+      return False
+    if self.dev is None:
+      return True
+    return entry.stat(follow_symlinks=False).st_dev == self.dev
+
+  def KeepFile(self, stat):
+    """Return whether to keep a file that is not excluded, given its stat."""
+    if self.dev is not None and stat.st_dev != self.dev:
+      return False
+    if stat.st_size < self.min_size:
+      return False
+    return self.max_size is None or stat.st_size <= self.max_size
+
+
+def ScanDir(path, filt=None):
+  """Return (list of File, list of subdirectories) of a directory.
+
+  Symlinks are ignored. The type comes from the directory entry (d_type) and
+  files are stat'ed once, errors are ignored like os.walk does. If given,
+  filt is applied to entries before they are stat'ed."""
+  files, dirs = [], []
+  try:
+    with open_files.Hold(), os.scandir(path) as it:
+      for entry in it:
+        try:
+          if entry.is_dir(follow_symlinks=False):
+            if not filt or filt.KeepDir(entry):
+              dirs.append(entry.path)
+          elif entry.is_file(follow_symlinks=False):
+            if filt and filt.Excluded(entry):
+              continue
+            stat = entry.stat(follow_symlinks=False)
+            if not filt or filt.KeepFile(stat):
+              files.append(File(entry.path, stat))
+        except OSError:
+          continue
+  except OSError:
+    pass
+  return files, dirs
+
+
+def ListFiles(path, workers=16, filt=None):
+  """Return list of files in a path, ignoring symlinks.
+
+  Directories are scanned concurrently by a pool of threads so that listing
+  is bound by I/O latency on network filesystems. If given, filt prunes
+  files and directories during the walk, see Filter."""
   files = []  # List of File.
   p = ProgressClock('[*] Listing files')
-  for dirpath, _, filenames in os.walk(path):
-    for filename in filenames:
-      p.Tick()
-      path = os.path.join(dirpath, filename)
-      if os.path.isfile(path) and not os.path.islink(path):
-        files.append(File(path))
+  with stats.Phase('list'), \
+       concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = set([pool.submit(ScanDir, path, filt)])
+    while pending:
+      done, pending = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        dir_files, dirs = future.result()
+        for f in dir_files:
+          p.Tick()
+        stats.Count('list', len(dir_files))
+        files.extend(dir_files)
+        pending.update(pool.submit(ScanDir, d, filt) for d in dirs)
   p.End()
+  files.sort()
   return files
 
 
 class DupeList(object):
-  """Class representing a list of duplicates with helpers."""
+  """Class representing a list of duplicates with helpers.
+
+  Sets are kept in a disjoint-set forest (union-find) with path compression
+  and union by rank, so Insert, AddDup and IsDup are amortized O(alpha(n)).
+  """
 
   def __init__(self, duplist=None):
-    # List of disjoint set of Files.
-    self.duplist = duplist if duplist else []
+    self.parent = {}  # File: parent File, roots are their own parent.
+    self.rank = {}  # Root File: rank.
+    self.count = 0  # Number of disjoint sets.
+    for a_set in duplist or []:
+      self.Insert(a_set)
 
   def __repr__(self):
-    return 'DupeList(%s)' % repr(self.duplist)
+    return 'DupeList(%s)' % repr(list(self))
 
   def __len__(self):
-    return len(self.duplist)
+    return self.count
 
   def __iter__(self):
-    return self.duplist.__iter__()
+    # Disjoint sets of Files, in order of first insertion.
+    sets = {}
+    for element in self.parent:
+      sets.setdefault(self._Find(element), set()).add(element)
+    return iter(list(sets.values()))
+
+  def _Find(self, element):
+    root = element
+    while self.parent[root] != root:
+      root = self.parent[root]
+    while self.parent[element] != root:
+      self.parent[element], element = root, self.parent[element]
+    return root
+
+  def _Add(self, element):
+    if element not in self.parent:
+      self.parent[element] = element
+      self.rank[element] = 0
+      self.count += 1
+
+  def _Union(self, a, b):
+    a, b = self._Find(a), self._Find(b)
+    if a == b:
+      return
+    if self.rank[a] < self.rank[b]:
+      a, b = b, a
+    self.parent[b] = a
+    if self.rank[a] == self.rank[b]:
+      self.rank[a] += 1
+    del self.rank[b]
+    self.count -= 1
 
   def Insert(self, a_set):
-    for dupset in self.duplist:
-      if dupset.intersection(a_set):
-        dupset.update(a_set)
-        return
-    self.duplist.append(a_set)
+    first = None
+    for element in a_set:
+      self._Add(element)
+      if first is None:
+        first = element
+      else:
+        self._Union(first, element)
 
   def Merge(self, a_duplist):
     for a_dupset in a_duplist:
       self.Insert(a_dupset)
 
   def AddDup(self, a, b):
-    self.Insert(set([a, b]))
+    self.Insert([a, b])
 
   def IsDup(self, element):
-    for dupset in self.duplist:
-      if element in dupset:
-        return True
+    return element in self.parent
 
 
-def FindDups(files, min_size=0, block_size=4096):
-  """Find duplicate files in a list of File elements, two passes."""
-  work = DupeList()
-  # Binomial coefficient C(len(files), 2)
-  total = len(files) * (len(files) - 1) / 2
-  p = ProgressPercent('[+] Triage obvious dups/non-dups', total)
-  for file1, file2 in itertools.combinations(files, 2):
-    p.Tick()
-    if file1.size < min_size or file2.size < min_size:
-      continue
-    if not file1.ObviousDuplicate(file2) and file1.PotentialDuplicate(file2):
-      work.AddDup(file1, file2)
+class HashCache(object):
+  """Persistent cache of file hashes in a SQLite database.
+
+  Hashes are stored by (st_dev, st_ino) and hash name, and are valid as long
+  as st_size and st_mtime_ns did not change. Changes are committed every
+  FLUSH_EVERY new hashes or hits and on Flush(), so an interrupted run keeps
+  what it hashed. On Close(), least recently used entries are evicted until
+  the cache holds at most max_size bytes."""
+
+  MAX_SIZE = 256 << 20
+  ROW_OVERHEAD = 48  # Approximate bytes per entry besides name and digest.
+  FLUSH_EVERY = 1000
+
+  def __init__(self, path, max_size=MAX_SIZE):
+    self.db = sqlite3.connect(path)
+    self.db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                    'dev INTEGER, ino INTEGER, name TEXT, size INTEGER, '
+                    'mtime_ns INTEGER, digest BLOB, used INTEGER, '
+                    'PRIMARY KEY (dev, ino, name))')
+    self.db.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+    self.max_size = max_size
+    self.now = int(time.time())
+    self.changes = 0  # Puts and hits since the last commit.
+    self.hits = []  # (used, dev, ino, name) of hits to update on Flush().
+
+  @staticmethod
+  def _Key(f):
+    # SQLite integers are signed 64 bits, inode numbers may not fit.
+    dev, ino = f.dev_inode
+    return dev, ino - (1 << 64) if ino >= 1 << 63 else ino
+
+  def Get(self, f, name):
+    """Return the cached digest of File f, or None."""
+    dev, ino = self._Key(f)
+    row = self.db.execute('SELECT size, mtime_ns, digest FROM hashes '
+                          'WHERE dev = ? AND ino = ? AND name = ?',
+                          (dev, ino, name)).fetchone()
+    if not row or (row[0], row[1]) != (f.size, f.mtime_ns):
+      return None
+    self.hits.append((self.now, dev, ino, name))
+    self._Changed()
+    return row[2]
+
+  def Put(self, f, name, digest):
+    dev, ino = self._Key(f)
+    self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (dev, ino, name, f.size, f.mtime_ns, digest, self.now))
+    self._Changed()
+
+  def _Changed(self):
+    self.changes += 1
+    if self.changes >= self.FLUSH_EVERY:
+      self.Flush()
+
+  def Flush(self):
+    """Save the last used time of hits and commit."""
+    self.db.executemany('UPDATE hashes SET used = ? '
+                        'WHERE dev = ? AND ino = ? AND name = ?', self.hits)
+    self.hits = []
+    self.changes = 0
+    self.db.commit()
+
+  def Evict(self):
+    """Delete least recently used entries above max_size bytes."""
+    size, = self.db.execute('SELECT COALESCE(SUM(LENGTH(name) + '
+                            'LENGTH(digest) + ?), 0) FROM hashes',
+                            (self.ROW_OVERHEAD,)).fetchone()
+    excess = size - self.max_size
+    if excess <= 0:
+      return
+    rows = self.db.execute('SELECT rowid, LENGTH(name) + LENGTH(digest) + ? '
+                           'FROM hashes ORDER BY used', (self.ROW_OVERHEAD,))
+    evict = []
+    for rowid, row_size in rows:
+      if excess <= 0:
+        break
+      evict.append((rowid,))
+      excess -= row_size
+    self.db.executemany('DELETE FROM hashes WHERE rowid = ?', evict)
+
+  def Close(self):
+    self.Flush()
+    self.Evict()
+    self.db.commit()
+    self.db.close()
+
+
+def FindDups(files, min_size=0, block_size=None, cache=None, hasher=None,
+             found=None):
+  """Find duplicate files in a list of File elements, two passes.
+
+  Files are hashed by hasher, by default a Hasher in this process. If given,
+  found(dupset) is called with each set of duplicates as soon as it is
+  confirmed, hardlinks included."""
+  # Group files by size then by (dev, inode), so hardlinks are read only once.
+  by_size = {}  # size: {(dev, inode): [File]}
+  p = ProgressPercent('[+] Triage obvious dups/non-dups', len(files))
+  with stats.Phase('triage'):
+    for f in files:
+      p.Tick()
+      if f.size < min_size:
+        continue
+      by_size.setdefault(f.size, {}).setdefault(f.dev_inode, []).append(f)
+    work = [inodes for inodes in by_size.values() if len(inodes) > 1]
+
+    candidates = DupeList()
+    links = {}  # (dev, inode): [File]
+    for inodes in work:
+      candidates.Insert([same_inode[0] for same_inode in inodes.values()])
+      links.update(inodes)
+    stats.Count('triage', len(files))
+    stats.Skip('triage', sum(f.size for f in files) -
+                         sum(f.size for dupset in candidates for f in dupset))
   p.End()
 
   dups = DupeList()
-  p = ProgressPercent('[+] Find duplicates in same-size files', len(work))
-  for fileset in work:
-    p.Tick()
-    for f in fileset:
-      f.fp = open(f.path, 'rb')
-    file_size = list(fileset)[0].size
-    dups.Merge(SameSizeDups(DupeList([fileset]), file_size, block_size))
-    for f in fileset:
-      f.fp.close()
-  p.End()
+  def Found(dupset):
+    # Add back the hardlinks of the files found.
+    dupset = [link for f in dupset for link in links[f.dev_inode]]
+    dups.Insert(dupset)
+    if found:
+      found(dupset)
 
+  SameSizeDups(candidates, hasher or Hasher(block_size, cache), Found)
   return dups
 
 
-def SameSizeDups(duplist, file_size, block_size=4096):
-  """Takes a duplist of same size File and returns duplist of duplicates."""
-  offset = 0
-  while len(duplist) and offset < file_size:
+PARTIAL_SIZE = 4096  # Bytes hashed by the head and tail stages.
+
+
+class FileLimiter(object):
+  """Caps the number of file descriptors opened at once through Hold() and
+  Open().
+
+  Callers over the limit block until a descriptor is released, so the
+  concurrent directory scans, hashing and linking stay under the process
+  file descriptor limit. Linking holds two files at once, so the limit is at
+  least 2."""
+
+  def __init__(self, limit):
+    self.limit = max(2, limit)
+    self._semaphore = threading.BoundedSemaphore(self.limit)
+
+  def Hold(self):
+    """Context manager reserving one descriptor, e.g. for os.scandir."""
+    return self._semaphore
+
+  @contextlib.contextmanager
+  def Open(self, path, mode='rb'):
+    with self._semaphore:
+      with open(path, mode, buffering=0) as fp:
+        yield fp
+
+
+def DefaultMaxOpen():
+  """Return 256, or half the soft RLIMIT_NOFILE if lower."""
+  soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft == resource.RLIM_INFINITY:
+    return 256
+  return max(2, min(256, soft // 2))
+
+
+# Per process limiter used by ScanDir, HashPath, SameContent and Reflink, see
+# SetMaxOpen.
+open_files = FileLimiter(DefaultMaxOpen())
+
+
+def SetMaxOpen(limit):
+  global open_files
+  open_files = FileLimiter(limit)
+
+
+STAGES = ('head', 'tail', 'full')
+
+
+def StageBytes(size, stage):
+  """Return the number of bytes of a file of this size read by a stage."""
+  return size if stage == 'full' else min(size, PARTIAL_SIZE)
+
+
+MIN_BLOCK_SIZE = 64 << 10
+MAX_BLOCK_SIZE = 8 << 20
+MMAP_SIZE = 64 << 20  # Files at least this large are hashed through mmap.
+
+
+def BlockSize(size):
+  """Return the read block size for a file of this size: a power of two
+  around size/16, between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE."""
+  block_size = 1 << (size // 16).bit_length()
+  return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def HashBlocks(h, fp, size, block_size=None):
+  """Update hash h with the content of file fp, by blocks.
+
+  Large files are mapped in memory and hashed by memoryview slices, others
+  are read into a single reused buffer. Neither copies blocks into new
+  bytes objects."""
+  block_size = block_size or BlockSize(size)
+  if size >= MMAP_SIZE:
+    try:
+      mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+      mm = None
+    if mm is not None:
+      with mm:
+        if hasattr(mm, 'madvise'):
+          mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+          for offset in range(0, len(view), block_size):
+            h.update(view[offset:offset+block_size])
+      return
+  buf = bytearray(block_size)
+  with memoryview(buf) as view:
+    while True:
+      n = fp.readinto(buf)
+      if not n:
+        break
+      h.update(view[:n])
+
+
+def HashPath(path, size, stage, block_size=None):
+  """Return the BLAKE2b digest of a stage of a file.
+
+  Stages are 'head' (first PARTIAL_SIZE bytes), 'tail' (last PARTIAL_SIZE
+  bytes) and 'full' (whole file, see HashBlocks; block_size defaults to
+  BlockSize(size)). The file is opened through the open_files limiter."""
+  h = hashlib.blake2b(digest_size=32)
+  with open_files.Open(path) as fp:
+    if stage == 'head':
+      h.update(fp.read(PARTIAL_SIZE))
+    elif stage == 'tail':
+      fp.seek(max(0, size - PARTIAL_SIZE))
+      h.update(fp.read(PARTIAL_SIZE))
+    else:
+      HashBlocks(h, fp, size, block_size)
+  return h.digest()
+
+
+def Unreadable(f, e):
+  """Report a file that cannot be hashed on stderr."""
+  sys.stderr.write('[!] Cannot read %s: %s\n' % (f.path, e))
+
+
+class Hasher(object):
+  """Computes stage digests of files one after the other in this process,
+  going through the cache if any."""
+
+  def __init__(self, block_size=None, cache=None):
+    self.block_size = block_size
+    self.cache = cache
+
+  @staticmethod
+  def CacheName(stage):
+    return 'blake2b:%s:%d' % (stage, PARTIAL_SIZE)
+
+  def Cached(self, files, stage):
+    """Return ({File: digest} of cached files, list of other files)."""
+    digests, misses = {}, list(files)
+    if self.cache:
+      misses = []
+      name = self.CacheName(stage)
+      for f in files:
+        digest = self.cache.Get(f, name)
+        if digest is None:
+          misses.append(f)
+        else:
+          digests[f] = digest
+          stats.Skip('cache', StageBytes(f.size, stage))
+    for f in misses:
+      stats.Count('hash ' + stage, 1, StageBytes(f.size, stage))
+    return digests, misses
+
+  def Store(self, f, stage, digest):
+    if self.cache:
+      self.cache.Put(f, self.CacheName(stage), digest)
+
+  def Flush(self):
+    """Commit the cache, done at the end of each stage."""
+    if self.cache:
+      self.cache.Flush()
+
+  def Digests(self, files, stage):
+    """Return {File: digest} for a stage of files."""
+    return dict(self.Iter(files, stage))
+
+  def Iter(self, files, stage):
+    """Yield (File, digest) for a stage of files as they are hashed, cached
+    ones first. The digest is None for files that cannot be read."""
+    digests, misses = self.Cached(files, stage)
+    for item in digests.items():
+      yield item
+    p = ProgressPercent('[+] Hashing %s of %i files' % (stage, len(misses)),
+                        len(misses))
+    for f in misses:
+      p.Tick()
+      try:
+        digest = HashPath(f.path, f.size, stage, self.block_size)
+      except OSError as e:
+        Unreadable(f, e)
+        yield f, None
+        continue
+      self.Store(f, stage, digest)
+      yield f, digest
+    p.End()
+    self.Flush()
+
+  def Close(self):
+    pass
+
+
+def Rotational(dev):
+  """Return whether device dev is a spinning disk, False if unknown."""
+  base = '/sys/dev/block/%i:%i' % (os.major(dev), os.minor(dev))
+  # Partitions have their queue settings on the parent disk.
+  for path in (base + '/queue/rotational', base + '/../queue/rotational'):
+    try:
+      with open(path) as fp:
+        return fp.read().strip() == '1'
+    except OSError:
+      continue
+  return False
+
+
+class ParallelHasher(Hasher):
+  """Computes stage digests of files in a pool of processes.
+
+  Files are sharded by st_dev with one feeding thread (I/O queue) per device.
+  A spinning disk gets one read at a time, to avoid seeking between files,
+  other devices get as many as there are jobs."""
+
+  def __init__(self, jobs, block_size=None, cache=None):
+    super(ParallelHasher, self).__init__(block_size, cache)
+    self.jobs = jobs
+    self.pool = concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=SetMaxOpen, initargs=(open_files.limit,))
+
+  def _Feed(self, files, stage, depth, done):
+    """Submit the hashing of files, at most depth at a time, and put
+    (File, future) in the done queue as they complete."""
+    slots = threading.BoundedSemaphore(depth)
+    for f in sorted(files, key=lambda f: f.stat.st_ino):
+      slots.acquire()
+      future = self.pool.submit(HashPath, f.path, f.size, stage,
+                                self.block_size)
+      future.add_done_callback(
+          lambda future, f=f: (slots.release(), done.put((f, future))))
+
+  def Iter(self, files, stage):
+    digests, misses = self.Cached(files, stage)
+    for item in digests.items():
+      yield item
+    by_dev = {}
+    for f in misses:
+      by_dev.setdefault(f.stat.st_dev, []).append(f)
+    done = queue.Queue()
+    feeders = []
+    for dev, dev_files in by_dev.items():
+      depth = 1 if Rotational(dev) else self.jobs
+      t = threading.Thread(target=self._Feed,
+                           args=(dev_files, stage, depth, done))
+      t.daemon = True
+      t.start()
+      feeders.append(t)
+    p = ProgressPercent('[+] Hashing %s of %i files' % (stage, len(misses)),
+                        len(misses))
+    for _ in misses:
+      p.Tick()
+      f, future = done.get()
+      try:
+        digest = future.result()
+      except OSError as e:
+        Unreadable(f, e)
+        yield f, None
+        continue
+      self.Store(f, stage, digest)
+      yield f, digest
+    p.End()
+    self.Flush()
+    for t in feeders:
+      t.join()
+
+  def Close(self):
+    self.pool.shutdown()
+
+
+def SameSizeDups(duplist, hasher, found=None):
+  """Takes a duplist of sets of same size Files and returns duplist of
+  duplicates.
+
+  Each set is split by the digest of each stage in turn, sets left with a
+  single file are dropped. Files no larger than PARTIAL_SIZE are entirely
+  hashed by the head stage. All the files of a stage are given to the hasher
+  at once so that it can schedule reads. Files that cannot be read are
+  dropped from their set. If given, found(dupset) is called
+  with each set of duplicates as soon as its last stage is complete."""
+  dups = DupeList()
+  for stage in STAGES:
     tmplist = DupeList()
+    todo = []  # Sets of files to hash at this stage.
     for dupset in duplist:
+      if stage != 'head' and next(iter(dupset)).size <= PARTIAL_SIZE:
+        continue
+      todo.append(dupset)
+    # Split each set as soon as all its files are hashed.
+    pending = {}  # File: index in todo.
+    remaining = [len(dupset) for dupset in todo]
+    by_digest = [{} for dupset in todo]
+    for i, dupset in enumerate(todo):
       for f in dupset:
-        # Hash and forget about block: faster and less memory
-        f.hash = hashlib.md5(f.fp.read(block_size)).digest()
-    for dupset in duplist:
-      for file1, file2 in itertools.combinations(dupset, 2):
-        if file1.hash == file2.hash:
-          # Re-read this block and compare byte by byte.
-          file1.fp.seek(offset)
-          file2.fp.seek(offset)
-          if file1.fp.read(block_size) == file2.fp.read(block_size):
-            tmplist.AddDup(file1, file2)
-    offset += block_size
+        pending[f] = i
+    files = [f for dupset in todo for f in dupset]
+    with stats.Phase('hash ' + stage):
+      for f, digest in hasher.Iter(files, stage):
+        i = pending[f]
+        if digest is not None:
+          by_digest[i].setdefault(digest, []).append(f)
+        remaining[i] -= 1
+        if remaining[i]:
+          continue
+        last = stage == 'full' or f.size <= PARTIAL_SIZE
+        for same in by_digest[i].values():
+          if len(same) < 2:
+            if not last:
+              # Bytes not read thanks to partial hashes.
+              read = PARTIAL_SIZE * (STAGES.index(stage) + 1)
+              stats.Skip('partial', max(0, same[0].size - read))
+            continue
+          if last:
+            dups.Insert(same)
+            if found:
+              found(same)
+          else:
+            tmplist.Insert(same)
+        by_digest[i] = None
     duplist = tmplist
-  return duplist
+  return dups
 
 
-def ReportDups(duplist):
-  for dupset in duplist:
-    print
-    sys.stderr.write('Duplicates (%i bytes):\n' % list(dupset)[0].size)
+class Report(object):
+  """Writes sets of duplicates to fp in a format:
+    - text: the human readable report, paths on fp and the rest on stderr
+    - jsonl: a JSON object per set with size, wasted bytes and paths
+    - csv: a row per file with set number, size, wasted bytes and path
+    - null0: NUL terminated paths, an extra NUL after each set
+  Wasted bytes are the bytes that deduplicating the set would save.
+
+  Output goes to the binary buffer of fp, whatever its encoding. text, null0
+  and csv write paths as their original bytes (os.fsencode, CSV encoded with
+  errors='surrogateescape'). jsonl is ASCII: undecodable bytes of a path are
+  lone surrogates written as \\udcXX escapes, which os.fsencode turns back
+  into the original bytes."""
+
+  FORMATS = ('text', 'jsonl', 'csv', 'null0')
+
+  def __init__(self, format='text', fp=sys.stdout):
+    self.format = format
+    fp.flush()
+    self.fp = getattr(fp, 'buffer', fp)
+    self.count = 0
+    if format == 'csv':
+      self.text = io.StringIO()
+      self.csv = csv.writer(self.text)
+      self.csv.writerow(['set', 'size', 'wasted', 'path'])
+      self._WriteText()
+
+  def _WriteText(self):
+    """Write and clear the CSV rows buffered in self.text."""
+    self.fp.write(self.text.getvalue().encode(
+        sys.getfilesystemencoding(), 'surrogateescape'))
+    self.text.seek(0)
+    self.text.truncate()
+
+  def Add(self, dupset):
+    paths = sorted(f.path for f in dupset)
+    size = next(iter(dupset)).size
+    # Hardlinks do not waste space.
+    wasted = size * (len(set(f.dev_inode for f in dupset)) - 1)
+    self.count += 1
+    if self.format == 'text':
+      self.fp.write(b'\n')
+      self.fp.flush()
+      sys.stderr.write('Duplicates (%i bytes):\n' % size)
+      for path in paths:
+        sys.stderr.write('  ')
+        sys.stderr.flush()
+        self.fp.write(os.fsencode(path) + b'\n')
+        self.fp.flush()
+    elif self.format == 'jsonl':
+      line = json.dumps({'size': size, 'wasted': wasted, 'paths': paths})
+      self.fp.write(line.encode('ascii') + b'\n')
+    elif self.format == 'csv':
+      for path in paths:
+        self.csv.writerow([self.count, size, wasted, path])
+      self._WriteText()
+    elif self.format == 'null0':
+      self.fp.write(b'\0'.join(os.fsencode(path) for path in paths) +
+                    b'\0\0')
+    self.fp.flush()
+
+
+FICLONE = 0x40049409  # Linux ioctl _IOW(0x94, 9, int).
+
+
+def SameContent(path1, path2, block_size=MIN_BLOCK_SIZE):
+  """Return whether two files have the same content, compared byte by byte
+  through reused buffers."""
+  buf1, buf2 = bytearray(block_size), bytearray(block_size)
+  with open_files.Open(path1) as fp1, open_files.Open(path2) as fp2, \
+       memoryview(buf1) as view1, memoryview(buf2) as view2:
+    while True:
+      n1, n2 = fp1.readinto(buf1), fp2.readinto(buf2)
+      if n1 != n2 or view1[:n1] != view2[:n2]:
+        return False
+      if not n1:
+        return True
+
+
+def Reflink(src, dst):
+  """Create dst sharing the data blocks of src with FICLONE. Fails with
+  EOPNOTSUPP where reflinks are not supported rather than copying data."""
+  with open_files.Open(src) as fsrc, open_files.Open(dst, 'xb') as fdst:
+    try:
+      fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except BaseException as e:
+      os.unlink(dst)
+      if isinstance(e, OSError) and e.errno in (
+          errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV,
+          errno.ENOSYS):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks not supported')
+      raise
+
+
+class Linker(object):
+  """Replaces duplicates by links to the first file (by path) of their set on
+  the same device:
+    - hardlink: hardlinks
+    - reflink: copies sharing data blocks (FICLONE), which keep their own
+      metadata; files are left alone where reflinks are not supported
+    - dry-run: only tell what would be done
+  Empty files are left alone. Each file is checked to be unchanged since the
+  scan and identical byte by byte, then atomically replaced: the link is
+  created under a temporary name in the same directory and renamed over the
+  file. Saved bytes count each replaced inode once."""
+
+  MODES = ('hardlink', 'reflink', 'dry-run')
+
+  def __init__(self, mode, fp=sys.stderr):
+    self.mode = mode
+    self.fp = fp
+    self.linked = 0
+    self.saved = 0
+
+  def Link(self, dupset):
+    # Empty files save nothing, and linking them would share later writes.
+    if not next(iter(dupset)).size:
+      return
+    keepers = {}  # st_dev: File
+    replaced = set()  # (dev, inode) of replaced files, counted once.
     for f in sorted(dupset):
-      sys.stderr.write('  ')
-      print f.path
+      keeper = keepers.setdefault(f.stat.st_dev, f)
+      if f.dev_inode == keeper.dev_inode:
+        continue
+      try:
+        self._Replace(keeper, f)
+      except OSError as e:
+        self.fp.write('[!] Cannot link %s: %s\n' % (f.path, e))
+        continue
+      if f.dev_inode not in replaced:
+        replaced.add(f.dev_inode)
+        self.saved += f.size
+
+  def _Replace(self, keeper, f):
+    st = os.lstat(f.path)
+    if (st.st_ino, st.st_size, st.st_mtime_ns) != (
+        f.stat.st_ino, f.size, f.mtime_ns):
+      raise OSError(errno.EAGAIN, 'changed since scan')
+    if self.mode == 'dry-run':
+      self.fp.write('[-] Would link %s to %s\n' % (f.path, keeper.path))
+    else:
+      tmp = self._Create(keeper.path, f.path)
+      try:
+        if not SameContent(f.path, tmp):
+          raise OSError(errno.EAGAIN, 'content differs')
+        if self.mode == 'reflink':
+          shutil.copystat(f.path, tmp)
+          try:
+            os.chown(tmp, st.st_uid, st.st_gid)
+          except PermissionError:
+            pass
+        os.replace(tmp, f.path)
+      except BaseException:
+        os.unlink(tmp)
+        raise
+    self.linked += 1
+
+  def _Create(self, src, path):
+    """Create a link to src next to path and return its name."""
+    directory, name = os.path.split(path)
+    while True:
+      tmp = os.path.join(directory,
+                         '.%s.%s.dupes' % (name, os.urandom(4).hex()))
+      try:
+        if self.mode == 'hardlink':
+          os.link(src, tmp)
+        else:
+          Reflink(src, tmp)
+        return tmp
+      except FileExistsError:
+        continue
+
+  def End(self):
+    self.fp.write('[+] %s %i files, %i bytes saved\n' % (
+        'Would link' if self.mode == 'dry-run' else 'Linked',
+        self.linked, self.saved))
+
+
+def ReportDups(duplist, format='text'):
+  report = Report(format)
+  for dupset in duplist:
+    report.Add(dupset)
+
+
+def WriteStats(path):
+  """Write the JSON summary of stats to path, or stderr if path is -."""
+  if path == '-':
+    json.dump(stats.Summary(), sys.stderr, indent=2, sort_keys=True)
+    sys.stderr.write('\n')
+    return
+  with open(path, 'w') as fp:
+    json.dump(stats.Summary(), fp, indent=2, sort_keys=True)
+    fp.write('\n')
 
 
 def main():
-  if len(sys.argv) < 2:
-    print 'Usage: %s <path> [min size]' % sys.argv[0]
-    raise SystemExit
+  parser = argparse.ArgumentParser(description='Find duplicate files.')
+  parser.add_argument('path')
+  parser.add_argument('min_size_arg', metavar='min size', nargs='?',
+                      type=ParseSize, default=0)
+  parser.add_argument('--min-size', metavar='SIZE', type=ParseSize,
+                      help='ignore files smaller than this, with an optional '
+                           'k/M/G/T suffix (same as min size)')
+  parser.add_argument('--max-size', metavar='SIZE', type=ParseSize,
+                      help='ignore files larger than this')
+  parser.add_argument('--exclude', metavar='PATTERN', action='append',
+                      default=[],
+                      help='skip files and directories matching this glob '
+                           '(name or path), or this regexp if prefixed with '
+                           're: (directory paths end with /, repeatable)')
+  parser.add_argument('-x', '--one-file-system', action='store_true',
+                      help='do not descend into other filesystems')
+  parser.add_argument('--cache', metavar='PATH',
+                      help='keep file hashes in this SQLite database')
+  parser.add_argument('--cache-size', metavar='SIZE', type=ParseSize,
+                      default=HashCache.MAX_SIZE,
+                      help='evict least recently used cache entries above '
+                           'this size (default: %(default)s)')
+  parser.add_argument('--max-open', metavar='N', type=int,
+                      default=open_files.limit,
+                      help='maximum number of files and directories open '
+                           'at once per process, at least 2 '
+                           '(default: %(default)s)')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                      help='hash files in N processes, with one I/O queue '
+                           'per device (0: number of CPUs, default: 1)')
+  parser.add_argument('--format', choices=Report.FORMATS, default='text',
+                      help='output format; all but text are written as soon '
+                           'as each set of duplicates is found')
+  parser.add_argument('--link', choices=Linker.MODES,
+                      help='replace duplicates by hardlinks or reflinks to '
+                           'one file of their set as they are found')
+  parser.add_argument('--stats', metavar='PATH',
+                      help='write per phase timings and throughput as JSON '
+                           'to this file at exit (-: stderr)')
+  args = parser.parse_args()
+  SetMaxOpen(args.max_open)
+  min_size = args.min_size if args.min_size is not None else args.min_size_arg
+  dev = os.stat(args.path).st_dev if args.one_file_system else None
+  filt = Filter(args.exclude, min_size, args.max_size, dev)
+
+  cache = HashCache(args.cache, args.cache_size) if args.cache else None
+  if args.jobs == 1:
+    hasher = Hasher(cache=cache)
+  else:
+    hasher = ParallelHasher(args.jobs or os.cpu_count(), cache=cache)
+  # The text report comes at the end, not to interleave with progress.
+  report = Report(args.format) if args.format != 'text' else None
+  linker = Linker(args.link) if args.link else None
 
-  path = sys.argv[1]
-  min_size = sys.argv[2] if len(sys.argv) > 2 else 0
+  def Found(dupset):
+    if report:
+      with stats.Phase('report'):
+        report.Add(dupset)
+    if linker:
+      with stats.Phase('link'):
+        linker.Link(dupset)
 
-  files = ListFiles(path)
-  dups = FindDups(files, min_size)
-  ReportDups(dups)
+  try:
+    try:
+      files = ListFiles(args.path, filt=filt)
+      dups = FindDups(files, min_size, hasher=hasher, found=Found)
+    finally:
+      hasher.Close()
+      if cache:
+        cache.Close()
+    if not report:
+      with stats.Phase('report'):
+        ReportDups(dups)
+    if linker:
+      linker.End()
+  finally:
+    if args.stats:
+      WriteStats(args.stats)
 
 
 if '__main__' == __name__:
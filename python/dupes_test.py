@@ -0,0 +1,586 @@
+"""Unit tests for dupes.py, on files in a temporary directory."""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import dupes
+
+BIG = 3 * dupes.PARTIAL_SIZE + 5  # Goes through head, tail and full stages.
+
+
+class TempDirTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def Write(self, name, data):
+    path = os.path.join(self.dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def Paths(self, duplist):
+    return sorted(sorted(os.path.relpath(f.path, self.dir) for f in dupset)
+                  for dupset in duplist)
+
+
+class TestDupeList(unittest.TestCase):
+
+  def testUnion(self):
+    d = dupes.DupeList([[1, 2], [3, 4], [5]])
+    self.assertEqual(len(d), 3)
+    d.AddDup(2, 3)
+    self.assertEqual(len(d), 2)
+    self.assertEqual(sorted(sorted(s) for s in d), [[1, 2, 3, 4], [5]])
+    d.Merge([[5, 6], [7, 8]])
+    self.assertEqual(sorted(sorted(s) for s in d), [[1, 2, 3, 4], [5, 6],
+                                                    [7, 8]])
+    self.assertTrue(d.IsDup(6))
+    self.assertFalse(d.IsDup(9))
+
+  def testLongChain(self):
+    # Path compression keeps finds shallow on long chains of unions.
+    d = dupes.DupeList()
+    for i in range(10000):
+      d.AddDup(i, i + 1)
+    self.assertEqual(len(d), 1)
+    self.assertEqual(len(next(iter(d))), 10001)
+
+
+class TestParseSize(unittest.TestCase):
+
+  def testUnits(self):
+    for value, want in (('0', 0), ('123', 123), ('1k', 1024), ('1K', 1024),
+                        ('1.5M', 3 << 19), ('2GiB', 2 << 30), ('1TB', 1 << 40),
+                        ('10 kib', 10240)):
+      self.assertEqual(dupes.ParseSize(value), want, value)
+
+  def testInvalid(self):
+    for value in ('', 'k', '1x', '-1', '1kk'):
+      with self.assertRaises(argparse.ArgumentTypeError, msg=value):
+        dupes.ParseSize(value)
+
+
+class TestListFiles(TempDirTest):
+
+  def setUp(self):
+    super(TestListFiles, self).setUp()
+    self.Write('a.txt', b'a' * 10)
+    self.Write('b.tmp', b'b' * 10)
+    self.Write('big', b'c' * 5000)
+    self.Write('skip/x.txt', b'x')
+    self.Write('sub/y.txt', b'y' * 100)
+    os.symlink('a.txt', os.path.join(self.dir, 'link'))
+    os.symlink('sub', os.path.join(self.dir, 'dirlink'))
+
+  def List(self, filt=None):
+    return sorted(os.path.relpath(f.path, self.dir)
+                  for f in dupes.ListFiles(self.dir, filt=filt))
+
+  def testAll(self):
+    self.assertEqual(self.List(), ['a.txt', 'b.tmp', 'big', 'skip/x.txt',
+                                   'sub/y.txt'])
+
+  def testExclude(self):
+    filt = dupes.Filter(['*.tmp', 're:/sub/'])
+    self.assertEqual(self.List(filt), ['a.txt', 'big', 'skip/x.txt'])
+    filt = dupes.Filter(['*/skip/', 're:big$'])
+    self.assertEqual(self.List(filt), ['a.txt', 'b.tmp', 'sub/y.txt'])
+
+  def testExcludedDirNotScanned(self):
+    self.Write('.git/objects/o', b'o')
+    for excludes in (['skip', '.git'], ['re:/skip/', 're:/\\.git/'],
+                     ['*/skip/', '*/.git/']):
+      scanned = []
+      scandir = os.scandir
+      def ScanDir(path):
+        scanned.append(os.path.relpath(path, self.dir))
+        return scandir(path)
+      dupes.os.scandir = ScanDir
+      try:
+        got = self.List(dupes.Filter(excludes))
+      finally:
+        dupes.os.scandir = scandir
+      self.assertEqual(got, ['a.txt', 'b.tmp', 'big', 'sub/y.txt'])
+      self.assertEqual(sorted(scanned), ['.', 'sub'], excludes)
+
+  def testExcludedOnce(self):
+    calls = []
+    class Filter(dupes.Filter):
+      def Excluded(self, entry, is_dir=False):
+        calls.append(entry.name)
+        return super(Filter, self).Excluded(entry, is_dir)
+    self.List(Filter(['*.tmp']))
+    self.assertEqual(sorted(calls), ['a.txt', 'b.tmp', 'big', 'skip', 'sub',
+                                     'x.txt', 'y.txt'])
+
+  def testSize(self):
+    self.assertEqual(self.List(dupes.Filter(min_size=10, max_size=100)),
+                     ['a.txt', 'b.tmp', 'sub/y.txt'])
+    self.assertEqual(self.List(dupes.Filter(min_size=dupes.ParseSize('1k'))),
+                     ['big'])
+
+  def testOneFileSystem(self):
+    dev = os.stat(self.dir).st_dev
+    self.assertEqual(self.List(dupes.Filter(dev=dev)), self.List())
+    self.assertEqual(self.List(dupes.Filter(dev=dev + 1)), [])
+
+  def testStat(self):
+    for f in dupes.ListFiles(self.dir):
+      self.assertEqual(f.stat, os.lstat(f.path))
+
+
+class TestFindDups(TempDirTest):
+
+  def setUp(self):
+    super(TestFindDups, self).setUp()
+    data = os.urandom(BIG)
+    self.Write('a', data)
+    self.Write('b', data)
+    os.link(os.path.join(self.dir, 'a'), os.path.join(self.dir, 'alink'))
+    # Same size, differing in each stage.
+    self.Write('head', b'x' + data[1:])
+    self.Write('tail', data[:-1] + b'x')
+    self.Write('middle', data[:BIG//2] + b'x' + data[BIG//2+1:])
+    self.Write('other', data + b'x')
+    self.Write('small1', b'small')
+    self.Write('small2', b'small')
+    self.Write('empty1', b'')
+    self.Write('empty2', b'')
+
+  def testStages(self):
+    found = []
+    got = dupes.FindDups(dupes.ListFiles(self.dir), found=found.append)
+    want = [['a', 'alink', 'b'], ['empty1', 'empty2'], ['small1', 'small2']]
+    self.assertEqual(self.Paths(got), want)
+    self.assertEqual(self.Paths(found), want)
+
+  def testStagesHashed(self):
+    # Files are dropped at the first stage where they differ.
+    hashed = {}
+    class Hasher(dupes.Hasher):
+      def Iter(self, files, stage):
+        hashed[stage] = sorted(os.path.basename(f.path) for f in files)
+        return super(Hasher, self).Iter(files, stage)
+    dupes.FindDups(dupes.ListFiles(self.dir), min_size=BIG, hasher=Hasher())
+    self.assertEqual(hashed, {'head': ['a', 'b', 'head', 'middle', 'tail'],
+                              'tail': ['a', 'b', 'middle', 'tail'],
+                              'full': ['a', 'b', 'middle']})
+
+  def testMinSize(self):
+    got = dupes.FindDups(dupes.ListFiles(self.dir), min_size=10)
+    self.assertEqual(self.Paths(got), [['a', 'alink', 'b']])
+
+  def testHardlinksHashedOnce(self):
+    hashed = []
+    class Hasher(dupes.Hasher):
+      def Iter(self, files, stage):
+        hashed.extend(os.path.basename(f.path) for f in files)
+        return super(Hasher, self).Iter(files, stage)
+    dupes.FindDups(dupes.ListFiles(self.dir), min_size=BIG, hasher=Hasher())
+    self.assertEqual(len([f for f in hashed if f in ('a', 'alink')]), 3)
+
+  def testUnreadable(self):
+    files = dupes.ListFiles(self.dir)
+    os.unlink(os.path.join(self.dir, 'small2'))
+    for hasher in (dupes.Hasher(), dupes.ParallelHasher(2)):
+      try:
+        got = dupes.FindDups(files, min_size=1, hasher=hasher)
+      finally:
+        hasher.Close()
+      self.assertEqual(self.Paths(got), [['a', 'alink', 'b']])
+
+  def testParallel(self):
+    hasher = dupes.ParallelHasher(2)
+    try:
+      got = dupes.FindDups(dupes.ListFiles(self.dir), min_size=1,
+                           hasher=hasher)
+    finally:
+      hasher.Close()
+    self.assertEqual(self.Paths(got), [['a', 'alink', 'b'],
+                                       ['small1', 'small2']])
+
+
+class TestHashCache(TempDirTest):
+
+  def testInvalidation(self):
+    path = self.Write('f', b'data')
+    db = os.path.join(self.dir, 'cache.db')
+    cache = dupes.HashCache(db)
+    cache.Put(dupes.File(path), 'h', b'digest')
+    cache.Close()
+    cache = dupes.HashCache(db)
+    self.assertEqual(cache.Get(dupes.File(path), 'h'), b'digest')
+    self.assertIsNone(cache.Get(dupes.File(path), 'other'))
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    self.assertIsNone(cache.Get(dupes.File(path), 'h'))
+    cache.Close()
+
+  def testHasher(self):
+    data = os.urandom(BIG)
+    self.Write('a', data)
+    self.Write('b', data)
+    db = os.path.join(self.dir, 'cache.db')
+    for want_misses in (2, 0):
+      cache = dupes.HashCache(db)
+      hasher = dupes.Hasher(cache=cache)
+      files = dupes.ListFiles(self.dir)
+      files = [f for f in files if not f.path.endswith('.db')]
+      _, misses = hasher.Cached(files, 'full')
+      self.assertEqual(len(misses), want_misses)
+      self.assertEqual(self.Paths(dupes.FindDups(files, hasher=hasher)),
+                       [['a', 'b']])
+      cache.Close()
+
+  def testCommitted(self):
+    # Hashes survive a run that is interrupted before Close().
+    data = os.urandom(BIG)
+    files = [dupes.File(self.Write(name, data)) for name in ('a', 'b')]
+    db = os.path.join(self.dir, 'cache.db')
+    cache = dupes.HashCache(db)
+    dupes.FindDups(files, cache=cache)
+    other = dupes.HashCache(db)
+    name = dupes.Hasher.CacheName('full')
+    self.assertIsNotNone(other.Get(files[0], name))
+    other.Close()
+    cache.FLUSH_EVERY = 3
+    for i in range(3):
+      cache.Put(dupes.File(self.Write('f%d' % i, b'x')), 'h', b'digest')
+    other = dupes.HashCache(db)
+    self.assertEqual(other.Get(dupes.File(os.path.join(self.dir, 'f2')), 'h'),
+                     b'digest')
+    other.Close()
+    cache.Close()
+
+  def testEvict(self):
+    db = os.path.join(self.dir, 'cache.db')
+    files = [dupes.File(self.Write('f%d' % i, b'%d' % i)) for i in range(10)]
+    cache = dupes.HashCache(db)
+    for i, f in enumerate(files):
+      cache.now = i
+      cache.Put(f, 'h', b'x' * 32)
+    row = len('h') + 32 + cache.ROW_OVERHEAD
+    cache.max_size = 4 * row
+    cache.Close()
+    cache = dupes.HashCache(db)
+    got = [cache.Get(f, 'h') is not None for f in files]
+    self.assertEqual(got, [False] * 6 + [True] * 4)
+    cache.Close()
+
+  def testEvictHits(self):
+    # Hits refresh the last used time, so they are evicted last.
+    db = os.path.join(self.dir, 'cache.db')
+    files = [dupes.File(self.Write('f%d' % i, b'%d' % i)) for i in range(4)]
+    cache = dupes.HashCache(db)
+    cache.now = 1
+    for f in files:
+      cache.Put(f, 'h', b'x' * 32)
+    cache.Close()
+    cache = dupes.HashCache(db)
+    cache.now = 2
+    cache.Get(files[0], 'h')
+    cache.max_size = len('h') + 32 + cache.ROW_OVERHEAD
+    cache.Close()
+    cache = dupes.HashCache(db)
+    got = [cache.Get(f, 'h') is not None for f in files]
+    self.assertEqual(got, [True, False, False, False])
+    cache.Close()
+
+
+class TestFileLimiter(TempDirTest):
+
+  def setUp(self):
+    super(TestFileLimiter, self).setUp()
+    self.limit = dupes.open_files.limit
+    self.scandir = os.scandir
+    self.lock = threading.Lock()
+    self.open = 0
+    self.max_open = 0
+    dupes.SetMaxOpen(2)
+    dupes.os.scandir = self.Counted(os.scandir)
+    dupes.open = self.Counted(open)
+
+  def tearDown(self):
+    dupes.os.scandir = self.scandir
+    del dupes.open
+    dupes.SetMaxOpen(self.limit)
+    super(TestFileLimiter, self).tearDown()
+
+  def Counted(self, func):
+    """Wrap func opening a context manager to count how many are open."""
+    test = self
+    class Counted(object):
+      def __init__(self, *args, **kwargs):
+        self.obj = func(*args, **kwargs)
+        with test.lock:
+          test.open += 1
+          test.max_open = max(test.max_open, test.open)
+        time.sleep(0.001)  # Let other threads try to open more.
+      def __enter__(self):
+        return self.obj.__enter__()
+      def __exit__(self, *exc):
+        with test.lock:
+          test.open -= 1
+        return self.obj.__exit__(*exc)
+    return Counted
+
+  def testMaxOpen(self):
+    data = os.urandom(BIG)
+    for i in range(50):
+      self.Write('d%d/f' % i, data)
+    linker = dupes.Linker('hardlink', io.StringIO())
+    files = dupes.ListFiles(self.dir)
+    self.assertEqual(len(files), 50)
+    dupes.FindDups(files, found=linker.Link)
+    self.assertEqual(linker.linked, 49)
+    self.assertEqual(self.open, 0)
+    self.assertEqual(self.max_open, 2)
+
+
+class TestHashBlocks(TempDirTest):
+
+  def setUp(self):
+    super(TestHashBlocks, self).setUp()
+    self.mmap_size = dupes.MMAP_SIZE
+    self.mmap = mmap.mmap
+
+  def tearDown(self):
+    dupes.MMAP_SIZE = self.mmap_size
+    dupes.mmap.mmap = self.mmap
+    super(TestHashBlocks, self).tearDown()
+
+  def testBlockSize(self):
+    self.assertEqual(dupes.BlockSize(0), dupes.MIN_BLOCK_SIZE)
+    self.assertEqual(dupes.BlockSize(16 * dupes.MIN_BLOCK_SIZE - 1),
+                     dupes.MIN_BLOCK_SIZE)
+    self.assertEqual(dupes.BlockSize(16 * dupes.MIN_BLOCK_SIZE),
+                     2 * dupes.MIN_BLOCK_SIZE)
+    self.assertEqual(dupes.BlockSize(8 * dupes.MAX_BLOCK_SIZE - 1),
+                     dupes.MAX_BLOCK_SIZE // 2)
+    self.assertEqual(dupes.BlockSize(8 * dupes.MAX_BLOCK_SIZE),
+                     dupes.MAX_BLOCK_SIZE)
+    self.assertEqual(dupes.BlockSize(1 << 50), dupes.MAX_BLOCK_SIZE)
+    for size in range(0, 1 << 30, 12345678):
+      block_size = dupes.BlockSize(size)
+      self.assertEqual(block_size & (block_size - 1), 0)
+
+  def testMmap(self):
+    data = os.urandom(300000)
+    path = self.Write('f', data)
+    want = hashlib.blake2b(data, digest_size=32).digest()
+    mapped = []
+    def Mmap(*args, **kwargs):
+      mapped.append(args)
+      return self.mmap(*args, **kwargs)
+    dupes.mmap.mmap = Mmap
+    for mmap_size in (1 << 40, len(data), 1):
+      dupes.MMAP_SIZE = mmap_size
+      for block_size in (None, 4096, 100000, 1 << 20):
+        got = dupes.HashPath(path, len(data), 'full', block_size)
+        self.assertEqual(got, want, (mmap_size, block_size))
+    self.assertEqual(len(mapped), 8)
+
+
+class TestReport(TempDirTest):
+
+  def setUp(self):
+    super(TestReport, self).setUp()
+    # Not valid UTF-8.
+    self.paths = sorted([self.Write(os.fsdecode(b'caf\xe9'), b'x'),
+                         self.Write('b,"c"', b'x'),
+                         self.Write(u'\xe9t\xe9', b'x')])
+    self.files = [dupes.File(p) for p in self.paths]
+
+  def Output(self, format):
+    out = io.BytesIO()
+    report = dupes.Report(format, out)
+    report.Add(self.files)
+    report.Add(self.files[:2])
+    return out.getvalue()
+
+  def testNull0(self):
+    want = b'\0'.join(os.fsencode(p) for p in self.paths) + b'\0\0'
+    want += b'\0'.join(os.fsencode(p) for p in self.paths[:2]) + b'\0\0'
+    self.assertEqual(self.Output('null0'), want)
+
+  def testText(self):
+    want = b'\n' + b''.join(os.fsencode(p) + b'\n' for p in self.paths)
+    want += b'\n' + b''.join(os.fsencode(p) + b'\n' for p in self.paths[:2])
+    self.assertEqual(self.Output('text'), want)
+
+  def testJsonl(self):
+    lines = self.Output('jsonl').decode('ascii').splitlines()
+    self.assertEqual(len(lines), 2)
+    got = json.loads(lines[0])
+    self.assertEqual(got, {'size': 1, 'wasted': 2, 'paths': self.paths})
+    self.assertEqual([os.fsencode(p) for p in got['paths']],
+                     [os.fsencode(p) for p in self.paths])
+    self.assertEqual(json.loads(lines[1])['paths'], self.paths[:2])
+
+  def testCsv(self):
+    text = self.Output('csv').decode(sys.getfilesystemencoding(),
+                                     'surrogateescape')
+    rows = list(csv.reader(io.StringIO(text, newline='')))
+    self.assertEqual(rows[0], ['set', 'size', 'wasted', 'path'])
+    want = [['1', '1', '2', p] for p in self.paths]
+    want += [['2', '1', '1', p] for p in self.paths[:2]]
+    self.assertEqual(rows[1:], want)
+
+
+class TestLinker(TempDirTest):
+
+  def setUp(self):
+    super(TestLinker, self).setUp()
+    data = os.urandom(1000)
+    for name in ('a', 'b', 'c'):
+      self.Write(name, data)
+    os.link(os.path.join(self.dir, 'c'), os.path.join(self.dir, 'clink'))
+    self.Write('empty1', b'')
+    self.Write('empty2', b'')
+    self.out = io.StringIO()
+
+  def Inodes(self):
+    return dict((name, os.stat(os.path.join(self.dir, name)).st_ino)
+                for name in os.listdir(self.dir))
+
+  def Run(self, mode):
+    linker = dupes.Linker(mode, self.out)
+    dupes.FindDups(dupes.ListFiles(self.dir), found=linker.Link)
+    return linker
+
+  def testHardlink(self):
+    linker = self.Run('hardlink')
+    inodes = self.Inodes()
+    self.assertEqual(inodes['a'], inodes['b'])
+    self.assertEqual(inodes['a'], inodes['c'])
+    self.assertEqual(inodes['a'], inodes['clink'])
+    self.assertNotEqual(inodes['empty1'], inodes['empty2'])
+    self.assertEqual((linker.linked, linker.saved), (3, 2000))
+    self.assertEqual(sorted(os.listdir(self.dir)),
+                     ['a', 'b', 'c', 'clink', 'empty1', 'empty2'])
+
+  def testDryRun(self):
+    before = self.Inodes()
+    linker = self.Run('dry-run')
+    self.assertEqual(self.Inodes(), before)
+    self.assertEqual((linker.linked, linker.saved), (3, 2000))
+
+  def testChangedSinceScan(self):
+    linker = dupes.Linker('hardlink', self.out)
+    files = dupes.ListFiles(self.dir)
+    path = os.path.join(self.dir, 'b')
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    dupes.FindDups(files, found=linker.Link)
+    inodes = self.Inodes()
+    self.assertNotEqual(inodes['a'], inodes['b'])
+    self.assertEqual(inodes['a'], inodes['c'])
+    self.assertIn('changed since scan', self.out.getvalue())
+    self.assertEqual((linker.linked, linker.saved), (2, 1000))
+
+
+class TestStats(TempDirTest):
+
+  def setUp(self):
+    super(TestStats, self).setUp()
+    self.monotonic = time.monotonic
+    self.now = 0.0
+    dupes.time.monotonic = lambda: self.now
+    self.stats = dupes.stats
+
+  def tearDown(self):
+    dupes.time.monotonic = self.monotonic
+    dupes.stats = self.stats
+    super(TestStats, self).tearDown()
+
+  def testPhases(self):
+    stats = dupes.Stats()
+    with stats.Phase('outer'):
+      self.now += 2
+      with stats.Phase('inner'):
+        self.now += 3
+        with stats.Phase('outer'):
+          self.now += 1
+      self.now += 4
+    with stats.Phase('inner'):
+      self.now += 0.5
+    stats.Count('inner', 10, 7 * 10**6)
+    stats.Count('inner', bytes_read=10**6)
+    stats.Skip('partial', 100)
+    stats.Skip('partial', 20)
+    stats.Skip('cache', 3)
+    self.now += 1
+    summary = stats.Summary()
+    self.assertEqual(summary['seconds'], 11.5)
+    self.assertEqual(summary['phases'], {
+      'outer': {'seconds': 7.0, 'files': 0, 'bytes_read': 0,
+                'files_per_s': 0.0, 'mb_per_s': 0.0},
+      'inner': {'seconds': 3.5, 'files': 11, 'bytes_read': 8 * 10**6,
+                'files_per_s': round(11 / 3.5, 1),
+                'mb_per_s': round(8 / 3.5, 3)},
+    })
+    self.assertEqual(summary['bytes_read'], 8 * 10**6)
+    self.assertEqual(summary['bytes_skipped'],
+                     {'triage': 0, 'partial': 120, 'cache': 3})
+
+  def testRun(self):
+    dupes.time.monotonic = self.monotonic
+    data = os.urandom(BIG)
+    self.Write('a', data)
+    self.Write('b', data)
+    self.Write('c', b'x' + data[1:])
+    self.Write('other', b'other')
+    db = os.path.join(self.dir, 'cache.db')
+    path = os.path.join(self.dir, 'stats.json')
+    for cached in (False, True):
+      dupes.stats = dupes.Stats()
+      cache = dupes.HashCache(db)
+      files = [f for f in dupes.ListFiles(self.dir)
+               if f.path not in (db, path)]
+      dupes.FindDups(files, cache=cache)
+      cache.Close()
+      dupes.WriteStats(path)
+      with open(path) as f:
+        summary = json.load(f)
+      phases = summary['phases']
+      self.assertEqual(sorted(phases), ['hash full', 'hash head', 'hash tail',
+                                        'list', 'triage'])
+      for phase in phases.values():
+        self.assertEqual(sorted(phase), ['bytes_read', 'files', 'files_per_s',
+                                         'mb_per_s', 'seconds'])
+      self.assertEqual(phases['triage']['files'], 4)
+      skipped = summary['bytes_skipped']
+      self.assertEqual(skipped['triage'], len(b'other'))
+      # c differs in its head: its tail and full were not read.
+      self.assertEqual(skipped['partial'], BIG - dupes.PARTIAL_SIZE)
+      partial = 2 * dupes.PARTIAL_SIZE
+      if cached:
+        self.assertEqual(summary['bytes_read'], 0)
+        self.assertEqual(skipped['cache'], 3 * dupes.PARTIAL_SIZE + partial +
+                         2 * BIG)
+      else:
+        self.assertEqual(phases['hash head']['files'], 3)
+        self.assertEqual(phases['hash full']['bytes_read'], 2 * BIG)
+        self.assertEqual(summary['bytes_read'],
+                         3 * dupes.PARTIAL_SIZE + partial + 2 * BIG)
+        self.assertEqual(skipped['cache'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
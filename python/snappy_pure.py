@@ -3,6 +3,18 @@
 The implementation is based on https://github.com/golang/snappy
 at commit 723cc1e459b8eea2dea4583200fd60757d40097a."""
 
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import io
+import itertools
+import os
+import shutil
+import struct
+import sys
+
 class Error(Exception):
   """Base error class for snappy module."""
 
@@ -35,7 +47,9 @@ class ErrorUnsupported(Error):
 #   - For l == 2, the offset ranges in [0, 1<<16) and the length in [1, 65).
 #     The length is 1 + m. The offset is the little-endian unsigned integer
 #     denoted by the next 2 bytes.
-#   - For l == 3, this tag is a legacy format that is no longer supported.
+#   - For l == 3, the offset ranges in [0, 1<<32) and the length in [1, 65).
+#     The length is 1 + m. The offset is the little-endian unsigned integer
+#     denoted by the next 4 bytes.
 
 tagLiteral = 0x00
 tagCopy1   = 0x01
@@ -44,8 +58,8 @@ tagCopy4   = 0x03
 
 checksumSize    = 4
 chunkHeaderSize = 4
-magicBody       = 'sNaPpY'
-magicChunk      = '\xff\x06\x00\x00' + magicBody
+magicBody       = b'sNaPpY'
+magicChunk      = b'\xff\x06\x00\x00' + magicBody
 # https://code.google.com/p/snappy/source/browse/trunk/framing_format.txt says
 # that "the uncompressed data in a chunk must be no longer than 65536 bytes".
 maxUncompressedChunkLen = 65536
@@ -64,7 +78,18 @@ def uint32(n):
 def uint64(n):
   return n & ((1<<64) - 1)
 
+try:
+  # Optional native CRC32C (https://pypi.org/project/crc32c/).
+  from crc32c import crc32c as nativeCrc32c
+except ImportError:
+  nativeCrc32c = None
+
 class CRC32(object):
+  """CRC32 computes table-driven CRC32 checksums for a reversed polynom.
+
+  Input is processed 8 bytes per step (slice-by-8). For the Castagnoli polynom
+  the native crc32c module is used when available."""
+
   def __init__(self, polynom):
     table = [0]*256
     for i in range(256):
@@ -76,11 +101,28 @@ class CRC32(object):
           fwd >>= 1
         table[i] = fwd & 0xffffffff
     self.table = table
+    # tables[k][i] is the crc of byte i followed by k zero bytes.
+    self.tables = [table]
+    for k in range(1, 8):
+      prev = self.tables[k-1]
+      self.tables.append([(c >> 8) ^ table[c & 0xff] for c in prev])
+    self.native = nativeCrc32c if polynom == 0x82F63B78 else None
 
   def Update(self, s):
+    if self.native is not None:
+      return self.native(s)
+    buf = memoryview(s).cast('B')
+    n8 = len(buf) & ~7
+    t0, t1, t2, t3, t4, t5, t6, t7 = self.tables
     crc = 0xffffffff
-    for c in s:
-      crc = (crc >> 8) ^ self.table[(crc ^ ord(c)) & 0xff]
+    for lo, hi in struct.iter_unpack('<II', buf[:n8]):
+      crc ^= lo
+      crc = (t7[crc & 0xff] ^ t6[(crc >> 8) & 0xff] ^
+             t5[(crc >> 16) & 0xff] ^ t4[crc >> 24] ^
+             t3[hi & 0xff] ^ t2[(hi >> 8) & 0xff] ^
+             t1[(hi >> 16) & 0xff] ^ t0[hi >> 24])
+    for c in buf[n8:]:
+      crc = (crc >> 8) ^ t0[(crc ^ c) & 0xff]
     return crc ^ 0xffffffff
 
 castagnoli = CRC32(0x82F63B78)
@@ -91,6 +133,11 @@ def crc(b):
   r = castagnoli.Update(b)
   return uint32((r>>15|r<<17) + 0xa282ead8)
 
+def maxEncodedLen(srcLen):
+  """maxEncodedLen returns the maximum length of a snappy block, given its
+  uncompressed length."""
+  return 32 + srcLen + srcLen//6
+
 def uvarint(buf):
   """uvarint decodes a uint64 from buf and returns that value and the number of
   bytes read (> 0). If an error occurred, the value is 0 and the number of
@@ -100,7 +147,7 @@ def uvarint(buf):
             and -n is the number of bytes read"""
   x, s = 0, 0
   for i in range(len(buf)):
-    b = ord(buf[i])
+    b = buf[i]
     if b < 0x80:
       if i > 9 or (i == 9 and b > 1):
         return 0, -(i + 1)  # overflow
@@ -116,7 +163,79 @@ def putuvarint(x):
     buf.append(uint8(x) | 0x80)
     x >>= 7
   buf.append(x)
-  return ''.join(chr(c) for c in buf)
+  return bytes(buf)
+
+# Optional NumPy for a vectorized uvarint_batch, imported on first use as it
+# adds about 100 ms to every import: False until then, None if unavailable.
+numpy = False
+
+def _numpy():
+  global numpy
+  if numpy is False:
+    try:
+      import numpy as np
+    except ImportError:
+      np = None
+    numpy = np
+  return numpy
+
+def uvarint_batch(buf):
+  """uvarint_batch decodes all the consecutive uint64 varints in buf and
+  returns them as an array('Q'). It raises ErrorCorrupt if buf ends in the
+  middle of a varint or a value is larger than 64 bits.
+
+  NumPy is used when available and buf is large enough to benefit."""
+  src = memoryview(buf).cast('B')
+  if len(src) >= 1024 and _numpy() is not None:
+    return _uvarintBatchNumpy(src)
+  out = array.array('Q')
+  append = out.append
+  x, s, n = 0, 0, 0
+  for b in src:
+    if b < 0x80:
+      if n > 9 or (n == 9 and b > 1):
+        raise ErrorCorrupt('varint overflows 64 bits')
+      append(x | b << s)
+      x, s, n = 0, 0, 0
+    else:
+      x |= (b & 0x7f) << s
+      s += 7
+      n += 1
+  if n:
+    raise ErrorCorrupt('truncated varint')
+  return out
+
+def _uvarintBatchNumpy(src):
+  a = numpy.frombuffer(src, dtype=numpy.uint8)
+  ends = numpy.flatnonzero(a < 0x80)
+  if len(ends) == 0 or ends[-1] != len(a) - 1:
+    raise ErrorCorrupt('truncated varint')
+  starts = numpy.empty_like(ends)
+  starts[:1] = 0
+  starts[1:] = ends[:-1] + 1
+  lengths = ends - starts + 1
+  if len(lengths) and (lengths.max() > 10 or
+                       (a[ends[lengths == 10]] > 1).any()):
+    raise ErrorCorrupt('varint overflows 64 bits')
+  values = numpy.zeros(len(ends), dtype=numpy.uint64)
+  for k in range(int(lengths.max()) if len(lengths) else 0):
+    sel = numpy.flatnonzero(lengths > k)
+    group = (a[starts[sel] + k] & 0x7f).astype(numpy.uint64)
+    values[sel] |= group << numpy.uint64(7 * k)
+  out = array.array('Q')
+  out.frombytes(values.tobytes())
+  return out
+
+def putuvarint_batch(values):
+  """putuvarint_batch encodes an iterable of uint64 as consecutive varints."""
+  buf = bytearray()
+  append = buf.append
+  for x in values:
+    while x >= 0x80:
+      append((x & 0x7f) | 0x80)
+      x >>= 7
+    append(x)
+  return bytes(buf)
 
 def decodedLen(src):
   """decodedLen returns the length of the decoded block and the number of bytes
@@ -129,12 +248,17 @@ def decodedLen(src):
   return v, n
 
 def decompress(buf):
-  """decompress returns the decompressed form of buf."""
-  dLen, s = decodedLen(buf)
-  src = [ord(c) for c in buf]
-  dst = [0]*dLen
+  """decompress returns the decompressed form of buf.
+
+  buf may be any object supporting the buffer protocol (bytes, bytearray,
+  memoryview). The output is written into a single preallocated bytearray."""
+  src = memoryview(buf).cast('B')
+  dLen, s = decodedLen(src)
+  dst = bytearray(dLen)
+  out = memoryview(dst)
+  srcLen = len(src)
   d, offset, length = 0, 0, 0
-  while s < len(src):
+  while s < srcLen:
     b = src[s] & 0x03
     if b == tagLiteral:
       x = src[s] >> 2
@@ -142,68 +266,85 @@ def decompress(buf):
         s += 1
       elif x == 60:
         s += 2
-        if s > len(src):
+        if s > srcLen:
           raise ErrorCorrupt
         x = src[s-1]
       elif x == 61:
         s += 3
-        if s > len(src):
+        if s > srcLen:
           raise ErrorCorrupt
         x = src[s-2] | (src[s-1] << 8)
       elif x == 62:
         s += 4
-        if s > len(src):
+        if s > srcLen:
           raise ErrorCorrupt
         x = src[s-3] | (src[s-2] << 8) | (src[s-1] << 16)
       elif x == 63:
         s += 5
-        if s > len(src):
+        if s > srcLen:
           raise ErrorCorrupt
         x = src[s-4] | (src[s-3] << 8) | (src[s-2] << 16) | (src[s-1] << 24)
       length = x + 1
       if length <= 0:
         raise Error('Unsupported literal length')
-      if length > len(dst)-d or length > len(src)-s:
+      if length > dLen-d or length > srcLen-s:
         raise ErrorCorrupt
-      dst = dst[:d] + src[s:s+length] + dst[d+length:]
+      out[d:d+length] = src[s:s+length]
       d += length
       s += length
       continue
 
     elif b == tagCopy1:
       s += 2
-      if s > len(src):
+      if s > srcLen:
         raise ErrorCorrupt
       length = 4 + ((src[s-2]>>2)&0x7)
       offset = ((src[s-2]&0xe0)<<3) | src[s-1]
 
     elif b == tagCopy2:
       s += 3
-      if s > len(src):
+      if s > srcLen:
         raise ErrorCorrupt
       length = 1 + (src[s-3]>>2)
       offset = src[s-2] | (src[s-1]<<8)
 
     elif b == tagCopy4:
-      raise Error('Unsupported COPY_4 tag')
+      s += 5
+      if s > srcLen:
+        raise ErrorCorrupt
+      length = 1 + (src[s-5]>>2)
+      offset = src[s-4] | (src[s-3]<<8) | (src[s-2]<<16) | (src[s-1]<<24)
 
     end = d + length
-    if offset > d or end > len(dst):
+    if offset <= 0 or offset > d or end > dLen:
       raise ErrorCorrupt
-    while d < end:
-      dst[d] = dst[d-offset]
-      d += 1
+    if offset >= length:
+      # Non-overlapping copy: a single slice assignment.
+      out[d:end] = out[d-offset:end-offset]
+      d = end
+    else:
+      # Overlapping copy: the bytes in [d-offset, d) repeat. Each pass copies
+      # everything produced so far since d-offset, doubling the chunk size.
+      start = d - offset
+      while d < end:
+        n = min(d - start, end - d)
+        out[d:d+n] = out[start:start+n]
+        d += n
 
   if d != dLen:
     raise ErrorCorrupt
-  return ''.join(chr(c) for c in dst[:d])
+  out.release()
+  return bytes(dst)
 
-maxOffset = 1 << 15
+# maxOffset bounds how far back the compressor looks for matches: the whole
+# 64 KiB window of a framing format chunk, reachable with 2-byte offsets.
+maxOffset = 1 << 16
 
-def emitLiteral(lit):
-  """emitLiteral returns a literal chunk."""
+def emitLiteral(dst, lit):
+  """emitLiteral appends a literal chunk to dst and returns the number of bytes
+  written."""
   n = len(lit) - 1
-  dst = []
+  i = len(dst)
   if n < 60:
     dst.append((uint8(n)<<2) | tagLiteral)
   elif n < (1<<8):
@@ -226,12 +367,20 @@ def emitLiteral(lit):
     dst.append(uint8(n >> 24))
   else:
     raise Error("Source buffer is too long")
-  dst.extend(lit)
-  return dst
-
-def emitCopy(offset, length):
-  """emitCopy writes a copy chunk and returns the number of bytes written."""
-  dst = []
+  dst += lit
+  return len(dst) - i
+
+def emitCopy(dst, offset, length):
+  """emitCopy appends a copy chunk to dst and returns the number of bytes
+  written."""
+  i = len(dst)
+  while length > 0 and offset >= (1<<16):
+    x = length
+    if x > (1<<6):
+      x = 1 << 6
+    dst.append((uint8(x-1)<<2) | tagCopy4)
+    dst += struct.pack('<I', offset)
+    length -= x
   while length > 0:
     x = length - 4
     if 0 <= x and x < (1<<3) and offset < (1<<11):
@@ -246,37 +395,141 @@ def emitCopy(offset, length):
     dst.append(uint8(offset))
     dst.append(uint8(offset >> 8))
     length -= x
-  return dst
+  return len(dst) - i
+
+load32 = struct.Struct('<I').unpack_from
+load64 = struct.Struct('<Q').unpack_from
+
+# Compression levels. Both produce standard Snappy blocks.
+levelFastest = 1  # Single 4-byte hash probe, as in the reference encoder.
+levelBetter  = 2  # Larger tables, two probes and lazy matching.
+
+def extendMatch(src, s, t, srcLen):
+  """extendMatch returns the largest k such that k <= srcLen and that
+  src[s:k] == src[t:t+k-s], comparing 8 bytes at a time first."""
+  while s+8 <= srcLen and src[s:s+8] == src[t:t+8]:
+    s += 8
+    t += 8
+  while s < srcLen and src[s] == src[t]:
+    s += 1
+    t += 1
+  return s
+
+def encodeBlockBetter(dst, src):
+  """encodeBlockBetter appends the encoded form of src, longer than 4 bytes,
+  to dst.
+
+  It is modeled on golang/snappy's "better" encoder: a table of 8-byte hashes
+  finds long matches and a table of 4-byte hashes short ones, both are probed
+  at each position and the longest match wins. A match is only taken if the
+  next position does not start a longer one (lazy matching), and is extended
+  backwards into pending literal bytes."""
+  srcLen = len(src)
+  maxOff = maxOffset
+  # Table sizes follow the input size, up to 1<<17 and 1<<14 entries.
+  lBits = max(8, min(17, srcLen.bit_length()))
+  sBits = max(8, min(14, srcLen.bit_length()))
+  lShift, sShift = 64-lBits, 32-sBits
+  lTable = array.array('I', bytes(4 << lBits))
+  sTable = array.array('I', bytes(4 << sBits))
+
+  def index(i):
+    """index records position i in both tables and returns the previous
+    candidates (or -1) and the 4 bytes at i."""
+    h4, = load32(src, i)
+    p = uint32(h4*0x1e35a7bd)>>sShift
+    cs, sTable[p] = sTable[p]-1, i+1
+    cl = -1
+    if i+8 <= srcLen:
+      h8, = load64(src, i)
+      p = uint64((h8<<8)*0xcf1bbcdcb7a56463)>>lShift
+      cl, lTable[p] = lTable[p]-1, i+1
+    return cl, cs, h4
+
+  def match(s):
+    """match indexes s and returns the longest match at s as (t, length),
+    length 0 meaning no match."""
+    cl, cs, h4 = index(s)
+    best, bestLen = -1, 0
+    for t in (cl, cs):
+      if t < 0 or s-t >= maxOff or h4 != load32(src, t)[0]:
+        continue
+      n = extendMatch(src, s+4, t+4, srcLen) - s
+      if n > bestLen:
+        best, bestLen = t, n
+    return best, bestLen
 
-def compress(buf):
-  """compress returns the compressed form of buf."""
-  src = [ord(c) for c in buf]
+  s = 0    # The iterator position.
+  lit = 0  # The start position of any pending literal bytes.
+  while s+3 < srcLen:
+    t, n = match(s)
+    if n == 0:
+      s += 1
+      continue
+    # Lazy matching: prefer a longer match starting at the next byte.
+    while s+4 < srcLen:
+      t1, n1 = match(s+1)
+      if n1 <= n:
+        break
+      s, t, n = s+1, t1, n1
+    # Extend the match backwards over pending literal bytes.
+    while t > 0 and s > lit and src[t-1] == src[s-1]:
+      s, t, n = s-1, t-1, n+1
+    if lit != s:
+      emitLiteral(dst, src[lit:s])
+    emitCopy(dst, s-t, n)
+    # Index a few positions at both ends of the match, like golang/snappy:
+    # indexing all of them costs as much as the match saves.
+    end = s + n
+    for i in sorted(set((s+1, s+2, end-2, end-1))):
+      if s < i < srcLen-3:
+        index(i)
+    s = lit = end
+
+  if lit != srcLen:
+    emitLiteral(dst, src[lit:])
+
+def compress(buf, level=levelFastest):
+  """compress returns the compressed form of buf.
+
+  buf may be any object supporting the buffer protocol. It is read in place,
+  the hash table is an array of tableSize 32-bit entries and the output is
+  appended to a bytearray. level is levelFastest or levelBetter, which trades
+  speed for a smaller output."""
+  if level not in (levelFastest, levelBetter):
+    raise Error('Unknown compression level %r' % level)
+  src = memoryview(buf).cast('B')
+  srcLen = len(src)
 
   # The block starts with the varint-encoded length of the decompressed bytes.
-  dst = [ord(c) for c in putuvarint(len(src))]
+  dst = bytearray(putuvarint(srcLen))
 
   # Return early if src is short.
-  if len(src) <= 4:
-    if len(src) != 0:
-      dst.extend(emitLiteral(src))
-    return dst
+  if srcLen <= 4:
+    if srcLen != 0:
+      emitLiteral(dst, src)
+    return bytes(dst)
+
+  if level == levelBetter:
+    encodeBlockBetter(dst, src)
+    return bytes(dst)
 
   # Initialize the hash table. Its size ranges from 1<<8 to 1<<14 inclusive.
   maxTableSize = 1 << 14
   shift, tableSize = 32-8, 1<<8
-  while tableSize < maxTableSize and tableSize < len(src):
+  while tableSize < maxTableSize and tableSize < srcLen:
     shift -= 1
     tableSize *= 2
-  table = [0]*maxTableSize
+  table = array.array('I', bytes(4*tableSize))
+  maxOff = maxOffset
 
   # Iterate over the source bytes.
   s = 0    # The iterator position.
   t = 0    # The last position with the same hash as s.
   lit = 0  # The start position of any pending literal bytes.
-  while s+3 < len(src):
+  while s+3 < srcLen:
     # Update the hash table.
-    b0, b1, b2, b3 = src[s], src[s+1], src[s+2], src[s+3]
-    h = uint32(b0) | (uint32(b1)<<8) | (uint32(b2)<<16) | (uint32(b3)<<24)
+    h, = load32(src, s)
     p = uint32(h*0x1e35a7bd)>>shift
     # We need to to store values in [-1, inf) in table. To save
     # some initialization time, (re)use the table's zero value
@@ -284,23 +537,411 @@ def compress(buf):
     # subtract 1 on reads.
     t, table[p] = table[p]-1, s+1
     # If t is invalid or src[s:s+4] differs from src[t:t+4], accumulate a literal byte.
-    if t < 0 or s-t >= maxOffset or b0 != src[t] or b1 != src[t+1] or b2 != src[t+2] or b3 != src[t+3]:
+    if t < 0 or s-t >= maxOff or h != load32(src, t)[0]:
       s += 1
       continue
     # Otherwise, we have a match. First, emit any pending literal bytes.
     if lit != s:
-      dst.extend(emitLiteral(src[lit:s]))
+      emitLiteral(dst, src[lit:s])
     # Extend the match to be as long as possible.
     s0 = s
-    s, t = s+4, t+4
-    while s < len(src) and src[s] == src[t]:
-      s += 1
-      t += 1
+    s = extendMatch(src, s+4, t+4, srcLen)
     # Emit the copied bytes.
-    dst.extend(emitCopy(s-t, s-s0))
+    emitCopy(dst, s0-t, s-s0)
     lit = s
 
   # Emit any final pending literal bytes and return.
-  if lit != len(src):
-    dst.extend(emitLiteral(src[lit:]))
-  return ''.join(chr(c) for c in dst)
+  if lit != srcLen:
+    emitLiteral(dst, src[lit:])
+  return bytes(dst)
+
+
+# maxEncodedChunkLen is the largest valid compressed data chunk body: a
+# checksum followed by a block of at most maxUncompressedChunkLen bytes.
+maxEncodedChunkLen = checksumSize + maxEncodedLen(maxUncompressedChunkLen)
+
+def chunkHeader(chunkType, chunkLen):
+  """chunkHeader returns the 4 bytes header of a framing format chunk."""
+  return struct.pack('<I', chunkType | (chunkLen << 8))
+
+def encodeChunk(p, level=levelFastest):
+  """encodeChunk returns the framing format data chunk for p, which must be at
+  most maxUncompressedChunkLen bytes long, compressed at level."""
+  checksum = struct.pack('<I', crc(p))
+  body = compress(p, level)
+  # Store the data uncompressed if compression saves less than 12.5%.
+  if len(body) >= len(p) - len(p)//8:
+    chunkType, body = chunkTypeUncompressedData, bytes(p)
+  else:
+    chunkType = chunkTypeCompressedData
+  return chunkHeader(chunkType, checksumSize + len(body)) + checksum + body
+
+def decodeDataChunk(chunkType, chunk, verifyChecksum=True):
+  """decodeDataChunk returns the data held by a compressed or uncompressed
+  data chunk, given its type and body (the chunk without its header)."""
+  chunk = memoryview(chunk)
+  if len(chunk) < checksumSize:
+    raise ErrorCorrupt
+  checksum, = struct.unpack_from('<I', chunk)
+  if chunkType == chunkTypeCompressedData:
+    if len(chunk) > maxEncodedChunkLen:
+      raise ErrorCorrupt
+    block = chunk[checksumSize:]
+    n, _ = decodedLen(block)
+    if n > maxUncompressedChunkLen:
+      raise ErrorCorrupt
+    data = decompress(block)
+  elif chunkType == chunkTypeUncompressedData:
+    if len(chunk) > checksumSize + maxUncompressedChunkLen:
+      raise ErrorCorrupt
+    data = bytes(chunk[checksumSize:])
+  else:
+    raise ErrorCorrupt('not a data chunk: 0x%02x' % chunkType)
+  if verifyChecksum and crc(data) != checksum:
+    raise ErrorCorrupt('checksum mismatch')
+  return data
+
+class SnappyReader(io.RawIOBase):
+  """SnappyReader is a file-like object decompressing a stream in the framing
+  format read from fp.
+
+  At most one chunk is held in memory at a time, so arbitrarily large streams
+  are decompressed with constant memory."""
+
+  def __init__(self, fp, verifyChecksum=True):
+    self.fp = fp
+    self.verifyChecksum = verifyChecksum
+    self._buf = b''
+    self._pos = 0
+    self._readHeader = False
+
+  def readable(self):
+    return True
+
+  def _readFull(self, n, allowEOF=False):
+    """_readFull reads exactly n bytes from fp. It returns None if fp is at EOF
+    and allowEOF is set, a short read is a corrupt stream."""
+    data = self.fp.read(n)
+    if len(data) == n:
+      return data
+    parts = [data]
+    got = len(data)
+    while got < n:
+      data = self.fp.read(n - got)
+      if not data:
+        break
+      parts.append(data)
+      got += len(data)
+    if got == 0 and allowEOF:
+      return None
+    if got != n:
+      raise ErrorCorrupt
+    return b''.join(parts)
+
+  def _skip(self, n):
+    while n > 0:
+      chunk = self._readFull(min(n, maxUncompressedChunkLen))
+      n -= len(chunk)
+
+  def _fill(self):
+    """_fill decodes the next data chunk into the buffer. It returns False at
+    the end of the stream."""
+    while True:
+      header = self._readFull(chunkHeaderSize, allowEOF=True)
+      if header is None:
+        return False
+      chunkType = header[0]
+      chunkLen = header[1] | (header[2] << 8) | (header[3] << 16)
+      if not self._readHeader:
+        if chunkType != chunkTypeStreamIdentifier:
+          raise ErrorCorrupt
+        self._readHeader = True
+
+      if chunkType in (chunkTypeCompressedData, chunkTypeUncompressedData):
+        if chunkLen > maxEncodedChunkLen:
+          raise ErrorCorrupt
+        data = decodeDataChunk(chunkType, self._readFull(chunkLen),
+                               self.verifyChecksum)
+
+      elif chunkType == chunkTypeStreamIdentifier:
+        if chunkLen != len(magicBody) or self._readFull(chunkLen) != magicBody:
+          raise ErrorCorrupt
+        continue
+
+      elif chunkType <= 0x7f:
+        # Section 4.5. Reserved unskippable chunks (chunk types 0x02-0x7f).
+        raise ErrorUnsupported('unskippable chunk type 0x%02x' % chunkType)
+
+      else:
+        # Section 4.4 Padding (chunk type 0xfe).
+        # Section 4.6. Reserved skippable chunks (chunk types 0x80-0xfd).
+        self._skip(chunkLen)
+        continue
+
+      if data:
+        self._buf, self._pos = data, 0
+        return True
+
+  def readinto(self, b):
+    got = 0
+    while got < len(b):
+      if self._pos == len(self._buf) and not self._fill():
+        break
+      n = min(len(b) - got, len(self._buf) - self._pos)
+      b[got:got+n] = self._buf[self._pos:self._pos+n]
+      self._pos += n
+      got += n
+    return got
+
+class SnappyWriter(io.RawIOBase):
+  """SnappyWriter is a file-like object compressing data written to it into a
+  stream in the framing format written to fp.
+
+  Data is buffered and emitted in chunks of at most maxUncompressedChunkLen
+  bytes, compressed at level. flush() emits any pending data as a (possibly
+  short) chunk and close() flushes but does not close fp."""
+
+  def __init__(self, fp, level=levelFastest):
+    self.fp = fp
+    self.level = level
+    self._buf = bytearray()
+    self._wroteHeader = False
+
+  def writable(self):
+    return True
+
+  def _write(self, chunk):
+    if not self._wroteHeader:
+      self.fp.write(magicChunk)
+      self._wroteHeader = True
+    self.fp.write(chunk)
+
+  def _writeChunk(self, p):
+    self._write(encodeChunk(p, self.level))
+
+  def write(self, b):
+    if self.closed:
+      raise ValueError('write to closed file')
+    b = memoryview(b).cast('B')
+    n = len(b)
+    while len(b):
+      if not self._buf and len(b) >= maxUncompressedChunkLen:
+        self._writeChunk(b[:maxUncompressedChunkLen])
+        b = b[maxUncompressedChunkLen:]
+        continue
+      room = maxUncompressedChunkLen - len(self._buf)
+      self._buf += b[:room]
+      b = b[room:]
+      if len(self._buf) == maxUncompressedChunkLen:
+        self._writeChunk(self._buf)
+        del self._buf[:]
+    return n
+
+  def flush(self):
+    if self._buf:
+      self._writeChunk(self._buf)
+      del self._buf[:]
+    if hasattr(self.fp, 'flush'):
+      self.fp.flush()
+
+# A seekable stream is a regular framing format stream followed by an index
+# in a skippable chunk, so standard readers ignore it. The index chunk body is:
+#   - the masked crc of the rest of the index, 4 bytes,
+#   - the number n of data chunks, then n uncompressed lengths and n encoded
+#     lengths (header included) of the data chunks in order, as varints,
+#   - the total length of the index chunk (header included) as a
+#     little-endian uint32, then seekIndexMagic.
+# The fixed size trailer lets readers locate the index from the end.
+chunkTypeSeekIndex = 0x80
+seekIndexMagic     = b'sNaPpYiX'
+seekTrailerSize    = 4 + len(seekIndexMagic)
+
+class SeekableSnappyWriter(SnappyWriter):
+  """SeekableSnappyWriter is a SnappyWriter which also records the position of
+  every chunk and writes them as a trailing index on close(), for use by
+  SeekableSnappyReader."""
+
+  def __init__(self, fp, level=levelFastest):
+    super(SeekableSnappyWriter, self).__init__(fp, level)
+    self._uLens = []
+    self._cLens = []
+
+  def _writeChunk(self, p):
+    chunk = encodeChunk(p, self.level)
+    self._write(chunk)
+    self._uLens.append(len(p))
+    self._cLens.append(len(chunk))
+
+  def close(self):
+    if self.closed:
+      return
+    self.flush()
+    lens = putuvarint_batch([len(self._uLens)] + self._uLens + self._cLens)
+    chunkLen = checksumSize + len(lens) + seekTrailerSize
+    if chunkLen >= 1 << 24:
+      raise Error('seek index too large')
+    self._write(chunkHeader(chunkTypeSeekIndex, chunkLen) +
+                struct.pack('<I', crc(lens)) + lens +
+                struct.pack('<I', chunkHeaderSize + chunkLen) + seekIndexMagic)
+    super(SeekableSnappyWriter, self).close()
+
+class SeekableSnappyReader(io.RawIOBase):
+  """SeekableSnappyReader is a seekable file-like object decompressing a stream
+  written by SeekableSnappyWriter from the seekable fp.
+
+  Only the chunks covering the data actually read are read and decompressed,
+  the last one is kept in memory."""
+
+  def __init__(self, fp, verifyChecksum=True):
+    self.fp = fp
+    self.verifyChecksum = verifyChecksum
+    end = fp.seek(0, io.SEEK_END)
+    if end < len(magicChunk) + chunkHeaderSize + seekTrailerSize:
+      raise ErrorCorrupt('no seek index')
+    fp.seek(end - seekTrailerSize)
+    trailer = fp.read(seekTrailerSize)
+    if trailer[4:] != seekIndexMagic:
+      raise ErrorCorrupt('no seek index')
+    indexLen, = struct.unpack_from('<I', trailer)
+    indexStart = end - indexLen
+    if indexLen < chunkHeaderSize + checksumSize + seekTrailerSize or indexStart < 0:
+      raise ErrorCorrupt
+    fp.seek(indexStart)
+    index = fp.read(indexLen)
+    if index[0] != chunkTypeSeekIndex:
+      raise ErrorCorrupt
+    checksum, = struct.unpack_from('<I', index, chunkHeaderSize)
+    lens = index[chunkHeaderSize+checksumSize:-seekTrailerSize]
+    if crc(lens) != checksum:
+      raise ErrorCorrupt('checksum mismatch')
+    lens = uvarint_batch(lens)
+    n = lens[0] if lens else 0
+    if len(lens) != 1 + 2*n:
+      raise ErrorCorrupt
+    self._uOffsets = array.array('Q', [0])
+    self._uOffsets.extend(itertools.accumulate(lens[1:1+n]))
+    cLens = lens[1+n:]
+    # Data chunks directly precede the index, after the stream identifier.
+    start = indexStart - sum(cLens)
+    if start < len(magicChunk):
+      raise ErrorCorrupt
+    self._cOffsets = array.array('Q', [start])
+    self._cOffsets.extend(start + c for c in itertools.accumulate(cLens))
+    self._size = self._uOffsets[-1]
+    self._pos = 0
+    self._chunk = -1
+    self._buf = b''
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self._pos
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      pos = offset
+    elif whence == io.SEEK_CUR:
+      pos = self._pos + offset
+    elif whence == io.SEEK_END:
+      pos = self._size + offset
+    else:
+      raise ValueError('invalid whence (%r)' % whence)
+    if pos < 0:
+      raise ValueError('negative seek position %d' % pos)
+    self._pos = pos
+    return pos
+
+  def _load(self, i):
+    start, end = self._cOffsets[i], self._cOffsets[i+1]
+    self.fp.seek(start)
+    chunk = self.fp.read(end - start)
+    if len(chunk) != end - start:
+      raise ErrorCorrupt
+    data = decodeDataChunk(chunk[0], memoryview(chunk)[chunkHeaderSize:],
+                           self.verifyChecksum)
+    if len(data) != self._uOffsets[i+1] - self._uOffsets[i]:
+      raise ErrorCorrupt
+    self._chunk, self._buf = i, data
+
+  def readinto(self, b):
+    got = 0
+    while got < len(b) and self._pos < self._size:
+      i = bisect.bisect_right(self._uOffsets, self._pos) - 1
+      if i != self._chunk:
+        self._load(i)
+      p = self._pos - self._uOffsets[i]
+      n = min(len(b) - got, len(self._buf) - p)
+      b[got:got+n] = self._buf[p:p+n]
+      self._pos += n
+      got += n
+    return got
+
+def _chunks(src):
+  """_chunks yields maxUncompressedChunkLen sized pieces of src, a buffer or a
+  readable file object."""
+  if hasattr(src, 'read'):
+    while True:
+      p = src.read(maxUncompressedChunkLen)
+      if not p:
+        return
+      yield p
+  else:
+    src = memoryview(src).cast('B')
+    for i in range(0, len(src), maxUncompressedChunkLen):
+      yield bytes(src[i:i+maxUncompressedChunkLen])
+
+def compress_parallel(src, workers=None, dst=None, level=levelFastest):
+  """compress_parallel compresses src into a framing format stream, spreading
+  chunks over a pool of workers processes (default: number of CPUs).
+
+  src is a buffer or a readable file object. If dst is a writable file object
+  the stream is written to it, otherwise it is returned as bytes. Chunks are
+  written in input order and only a bounded number of them are in flight, so
+  file to file compression runs with constant memory. level is passed to
+  compress."""
+  out = io.BytesIO() if dst is None else dst
+  workers = workers or os.cpu_count() or 1
+  wroteHeader = False
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    pending = collections.deque()
+    for p in _chunks(src):
+      if len(pending) >= 4*workers:
+        out.write(pending.popleft().result())
+      if not wroteHeader:
+        out.write(magicChunk)
+        wroteHeader = True
+      pending.append(pool.submit(encodeChunk, p, level))
+    while pending:
+      out.write(pending.popleft().result())
+  if dst is None:
+    return out.getvalue()
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Compress or decompress stdin to stdout in the Snappy '
+                  'framing format.')
+  parser.add_argument('-d', '--decompress', action='store_true',
+                      help='decompress instead of compress')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='compress with this many processes (0: all CPUs)')
+  parser.add_argument('-b', '--better', action='store_const', dest='level',
+                      const=levelBetter, default=levelFastest,
+                      help='compress better but slower')
+  args = parser.parse_args()
+
+  src, dst = sys.stdin.buffer, sys.stdout.buffer
+  if args.decompress:
+    shutil.copyfileobj(SnappyReader(src), dst, maxUncompressedChunkLen)
+  elif args.jobs != 1:
+    compress_parallel(src, args.jobs or None, dst, args.level)
+  else:
+    with SnappyWriter(dst, args.level) as w:
+      shutil.copyfileobj(src, w, maxUncompressedChunkLen)
+  dst.flush()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,202 @@
+"""Benchmarks for Snappy compression pure python implementation.
+
+Measures throughput (MB/s) of compress, decompress and crc, and the
+compression ratio, on a built-in synthetic corpus: text, HTML, JSON, already
+compressed data and zeros. Results are printed as JSON.
+
+Compression is measured at both levels; better_gain_pct is how much smaller
+the levelBetter output is compared to levelFastest.
+
+Given a baseline (a previous JSON output), the run fails if any throughput
+regressed by more than the threshold percentage.
+
+Usage:
+  $ python snappy_pure_bench.py > baseline.json
+  $ python snappy_pure_bench.py --baseline baseline.json [--threshold 10]
+  $ python snappy_pure_bench.py --max-offset 32768  # old 32 KiB match window
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+import zlib
+
+import snappy_pure
+
+METRICS = ('compress_mbps', 'better_compress_mbps', 'decompress_mbps',
+           'crc_mbps')
+
+
+def textCorpus(n, seed=0):
+  """Pseudo-random English-like text, n bytes."""
+  rnd = random.Random(seed)
+  words = [''.join(rnd.choice('etaoinshrdlucmfwypvbgkjqxz')
+                   for _ in range(rnd.randint(1, 10))) for _ in range(5000)]
+  out = []
+  size = 0
+  while size < n:
+    w = rnd.choice(words)
+    out.append(w)
+    size += len(w) + 1
+  return ' '.join(out).encode()[:n]
+
+
+def htmlCorpus(n, seed=0):
+  """Pseudo-random HTML page, n bytes."""
+  rnd = random.Random(seed)
+  text = textCorpus(n, seed).decode().split(' ')
+  tags = ['p', 'div', 'span', 'a', 'li', 'td', 'h2']
+  out = ['<!DOCTYPE html>\n<html><head><title>bench</title></head><body>\n']
+  size = len(out[0])
+  i = 0
+  while size < n:
+    tag = rnd.choice(tags)
+    words = ' '.join(text[i:i+rnd.randint(3, 30)])
+    i = (i + 30) % len(text)
+    attrs = ' href="/page/%d"' % rnd.randint(0, 1000) if tag == 'a' else (
+        ' class="c%d"' % rnd.randint(0, 20))
+    s = '<%s%s>%s</%s>\n' % (tag, attrs, words, tag)
+    out.append(s)
+    size += len(s)
+  return ''.join(out).encode()[:n]
+
+
+def jsonCorpus(n, seed=0):
+  """Pseudo-random JSON records, one per line, n bytes."""
+  rnd = random.Random(seed)
+  words = textCorpus(1 << 16, seed).decode().split(' ')
+  out = []
+  size = 0
+  while size < n:
+    s = json.dumps({
+        'id': rnd.randint(0, 1 << 32),
+        'name': rnd.choice(words),
+        'tags': [rnd.choice(words) for _ in range(rnd.randint(0, 5))],
+        'score': round(rnd.random(), 4),
+        'active': rnd.random() < 0.5,
+    }) + '\n'
+    out.append(s)
+    size += len(s)
+  return ''.join(out).encode()[:n]
+
+
+def compressedCorpus(n, seed=0):
+  """Already compressed data (zlib of text), n bytes."""
+  out = []
+  size = 0
+  while size < n:
+    s = zlib.compress(textCorpus(1 << 18, seed + len(out)), 9)
+    out.append(s)
+    size += len(s)
+  return b''.join(out)[:n]
+
+
+def zerosCorpus(n, seed=0):
+  return b'\x00' * n
+
+
+CORPUS = (
+  ('text', textCorpus),
+  ('html', htmlCorpus),
+  ('json', jsonCorpus),
+  ('compressed', compressedCorpus),
+  ('zeros', zerosCorpus),
+)
+
+
+def timeit(f, arg, repeat):
+  """Returns the result of f(arg) and the best wall time over repeat runs."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = f(arg)
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return result, max(best, 1e-9)
+
+
+def bench(data, repeat):
+  mb = len(data) / 1e6
+  compressed, c = timeit(snappy_pure.compress, data, repeat)
+  decompressed, d = timeit(snappy_pure.decompress, compressed, repeat)
+  if decompressed != data:
+    raise AssertionError('round trip mismatch')
+  _, k = timeit(snappy_pure.crc, data, repeat)
+  better, b = timeit(
+      lambda x: snappy_pure.compress(x, snappy_pure.levelBetter), data, repeat)
+  if snappy_pure.decompress(better) != data:
+    raise AssertionError('round trip mismatch (better)')
+  return {
+    'size': len(data),
+    'ratio': round(len(compressed) / float(len(data)), 4),
+    'better_ratio': round(len(better) / float(len(data)), 4),
+    'better_gain_pct': round(
+        100 * (1 - len(better) / float(len(compressed))), 2),
+    'compress_mbps': round(mb / c, 3),
+    'better_compress_mbps': round(mb / b, 3),
+    'decompress_mbps': round(mb / d, 3),
+    'crc_mbps': round(mb / k, 3),
+  }
+
+
+def regressions(results, baseline, threshold):
+  """Returns a list of messages for throughputs more than threshold percent
+  below baseline."""
+  errors = []
+  for name, base in sorted(baseline.get('corpus', {}).items()):
+    if name not in results['corpus']:
+      continue
+    for metric in METRICS:
+      if metric not in base:
+        continue
+      want = base[metric] * (1 - threshold / 100.0)
+      got = results['corpus'][name][metric]
+      if got < want:
+        errors.append('%s %s: %.3f MB/s < %.3f MB/s (baseline %.3f, -%g%%)' % (
+            name, metric, got, want, base[metric], threshold))
+  return errors
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--size', type=int, default=1 << 20,
+                      help='bytes per corpus entry (default: 1 MiB)')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='runs per measure, best is kept (default: 3)')
+  parser.add_argument('--corpus', action='append',
+                      choices=[name for name, _ in CORPUS],
+                      help='only run this corpus entry (repeatable)')
+  parser.add_argument('--max-offset', type=int,
+                      help='override snappy_pure.maxOffset (match window)')
+  parser.add_argument('--baseline', help='JSON results to compare against')
+  parser.add_argument('--threshold', type=float, default=10,
+                      help='allowed throughput regression in percent '
+                           '(default: 10)')
+  args = parser.parse_args()
+
+  if args.max_offset:
+    snappy_pure.maxOffset = args.max_offset
+
+  results = {'corpus': {}}
+  for name, gen in CORPUS:
+    if args.corpus and name not in args.corpus:
+      continue
+    results['corpus'][name] = bench(gen(args.size), args.repeat)
+  json.dump(results, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write('\n')
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    errors = regressions(results, baseline, args.threshold)
+    for e in errors:
+      sys.stderr.write('regression: %s\n' % e)
+    if errors:
+      raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
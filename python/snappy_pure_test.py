@@ -7,21 +7,25 @@ Snappy reference implementation in C++: https://code.google.com/p/snappy/
 Python bindings: https://github.com/andrix/python-snappy
 """
 
+import io
+import os
 import random
 import snappy
 import snappy_pure
+import subprocess
+import sys
 import unittest
 
 
 def randBytes(n):
-  with open('/dev/urandom', 'r') as f:
+  with open('/dev/urandom', 'rb') as f:
     return f.read(n)
 
 
 class TestDecompress(unittest.TestCase):
 
   def testFile(self):
-    want = open('/etc/passwd', 'r').read()
+    want = open('/etc/passwd', 'rb').read()
     got = snappy_pure.decompress(snappy.compress(want))
     if got != want:
       raise AssertionError('got %r, want %r' % (got, want))
@@ -32,11 +36,25 @@ class TestDecompress(unittest.TestCase):
     if got != want:
       raise AssertionError('got %r, want %r' % (got, want))
 
+  def testRepeated(self):
+    # Short offsets produce overlapping copies.
+    for want in (b'\x00' * (1<<20), b'abc' * (1<<18)):
+      got = snappy_pure.decompress(memoryview(snappy.compress(want)))
+      if got != want:
+        raise AssertionError('got %r, want %r' % (got[:64], want[:64]))
+
+  def testCopy4(self):
+    # Literal 'abcd' then a COPY_4 of 8 bytes at offset 4.
+    got = snappy_pure.decompress(b'\x0c\x0cabcd\x1f\x04\x00\x00\x00')
+    self.assertEqual(got, b'abcd' * 3)
+    self.assertRaises(snappy_pure.ErrorCorrupt, snappy_pure.decompress,
+                      b'\x0c\x0cabcd\x1f\x05\x00\x00\x00')
+
 
 class TestCompress(unittest.TestCase):
 
   def testFile(self):
-    want = open('/etc/passwd', 'r').read()
+    want = open('/etc/passwd', 'rb').read()
     got = snappy.decompress(snappy_pure.compress(want))
     if got != want:
       raise AssertionError('got %r, want %r' % (got, want))
@@ -47,6 +65,181 @@ class TestCompress(unittest.TestCase):
     if got != want:
       raise AssertionError('got %r, want %r' % (got, want))
 
+  def testFarOffset(self):
+    # Repeats 40 KiB apart are only found with the 64 KiB window.
+    want = randBytes(40 << 10) * 2
+    compressed = snappy_pure.compress(want)
+    self.assertLess(len(compressed), len(want) * 3 // 4)
+    self.assertEqual(snappy.decompress(compressed), want)
+
+  def testCopy4(self):
+    lit = randBytes(1<<16)
+    dst = bytearray(snappy_pure.putuvarint(len(lit) + 100))
+    snappy_pure.emitLiteral(dst, lit)
+    snappy_pure.emitCopy(dst, len(lit), 100)
+    self.assertEqual(dst[-5] & 0x03, snappy_pure.tagCopy4)
+    got = snappy_pure.decompress(dst)
+    self.assertEqual(got, lit + lit[:100])
+
+  def testBetter(self):
+    # Compressible input: better must be strictly smaller.
+    for want in (open('/etc/passwd', 'rb').read() * 10,
+                 open(__file__, 'rb').read()):
+      better = snappy_pure.compress(want, snappy_pure.levelBetter)
+      self.assertEqual(snappy.decompress(better), want)
+      self.assertLess(len(better), len(snappy_pure.compress(want)))
+    # Incompressible or trivial input: no worse, up to a few bytes.
+    for want in (randBytes(random.randint(1, 1<<16)), b'\x00' * 100000,
+                 b'abcde'):
+      better = snappy_pure.compress(want, snappy_pure.levelBetter)
+      self.assertEqual(snappy.decompress(better), want)
+      self.assertLessEqual(len(better), len(snappy_pure.compress(want)) + 8)
+
+
+class TestFraming(unittest.TestCase):
+
+  def testReader(self):
+    want = randBytes(random.randint(1, 1<<20)) + b'a' * (1<<18)
+    dst = io.BytesIO()
+    snappy.stream_compress(io.BytesIO(want), dst)
+    dst.seek(0)
+    got = snappy_pure.SnappyReader(dst).read()
+    if got != want:
+      raise AssertionError('got %r, want %r' % (got[:64], want[:64]))
+
+  def testWriter(self):
+    want = randBytes(random.randint(1, 1<<20)) + b'a' * (1<<18)
+    dst = io.BytesIO()
+    w = snappy_pure.SnappyWriter(dst)
+    for i in range(0, len(want), 10000):
+      w.write(want[i:i+10000])
+    w.close()
+    dst.seek(0)
+    got = io.BytesIO()
+    snappy.stream_decompress(dst, got)
+    if got.getvalue() != want:
+      raise AssertionError('got %r, want %r' % (got.getvalue()[:64], want[:64]))
+
+  def testChecksum(self):
+    dst = io.BytesIO()
+    with snappy_pure.SnappyWriter(dst) as w:
+      w.write(b'a' * 1000)
+    stream = bytearray(dst.getvalue())
+    stream[len(snappy_pure.magicChunk) + snappy_pure.chunkHeaderSize] ^= 0xff
+    r = snappy_pure.SnappyReader(io.BytesIO(bytes(stream)))
+    self.assertRaises(snappy_pure.ErrorCorrupt, r.read)
+
+  def testParallel(self):
+    want = randBytes(random.randint(1, 1<<20)) + b'a' * (1<<18)
+    stream = snappy_pure.compress_parallel(want, workers=2)
+    serial = io.BytesIO()
+    with snappy_pure.SnappyWriter(serial) as w:
+      w.write(want)
+    self.assertEqual(stream, serial.getvalue())
+    got = io.BytesIO()
+    snappy.stream_decompress(io.BytesIO(stream), got)
+    if got.getvalue() != want:
+      raise AssertionError('got %r, want %r' % (got.getvalue()[:64], want[:64]))
+
+
+class TestSeekable(unittest.TestCase):
+
+  def testSeek(self):
+    want = randBytes(random.randint(1, 1<<20)) + b'a' * (1<<18)
+    dst = io.BytesIO()
+    w = snappy_pure.SeekableSnappyWriter(dst)
+    for i in range(0, len(want), 100000):
+      w.write(want[i:i+100000])
+      w.flush()  # Short chunks.
+    w.close()
+    stream = dst.getvalue()
+
+    # Standard readers skip the index.
+    got = io.BytesIO()
+    snappy.stream_decompress(io.BytesIO(stream), got)
+    self.assertEqual(got.getvalue(), want)
+    self.assertEqual(snappy_pure.SnappyReader(io.BytesIO(stream)).read(), want)
+
+    r = snappy_pure.SeekableSnappyReader(io.BytesIO(stream))
+    self.assertEqual(r.seek(0, io.SEEK_END), len(want))
+    for _ in range(100):
+      pos = random.randint(0, len(want))
+      n = random.randint(0, 200000)
+      r.seek(pos)
+      self.assertEqual(r.read(n), want[pos:pos+n])
+      self.assertEqual(r.tell(), min(pos + n, len(want)))
+    r.seek(0)
+    self.assertEqual(r.read(), want)
+
+  def testEmpty(self):
+    dst = io.BytesIO()
+    snappy_pure.SeekableSnappyWriter(dst).close()
+    r = snappy_pure.SeekableSnappyReader(dst)
+    self.assertEqual(r.read(), b'')
+
+  def testNoIndex(self):
+    dst = io.BytesIO()
+    with snappy_pure.SnappyWriter(dst) as w:
+      w.write(b'a' * 1000)
+    self.assertRaises(snappy_pure.ErrorCorrupt,
+                      snappy_pure.SeekableSnappyReader, dst)
+
+
+class TestUvarint(unittest.TestCase):
+
+  def values(self):
+    edges = [0, 1, 0x7f, 0x80, 0x3fff, 0x4000, (1<<32) - 1, (1<<64) - 1]
+    return edges + [random.getrandbits(random.randint(1, 64))
+                    for _ in range(5000)]
+
+  def check(self, values):
+    buf = snappy_pure.putuvarint_batch(values)
+    self.assertEqual(buf, b''.join(snappy_pure.putuvarint(x) for x in values))
+    self.assertEqual(list(snappy_pure.uvarint_batch(buf)), values)
+    self.assertEqual(list(snappy_pure.uvarint_batch(buf[:5])),
+                     list(snappy_pure.uvarint_batch(bytearray(buf[:5]))))
+
+  def testBatch(self):
+    self.check(self.values())
+    self.assertEqual(len(snappy_pure.uvarint_batch(b'')), 0)
+
+  def testPurePython(self):
+    saved, snappy_pure.numpy = snappy_pure.numpy, None
+    try:
+      self.check(self.values())
+    finally:
+      snappy_pure.numpy = saved
+
+  def testLazyNumpy(self):
+    out = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, snappy_pure; print("numpy" in sys.modules)'],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    self.assertEqual(out.strip(), b'False')
+
+  def testCorrupt(self):
+    for buf in (b'\x80', b'\x00' * 2000 + b'\xff',
+                b'\xff' * 9 + b'\x02', b'\x00' * 2000 + b'\xff' * 10 + b'\x01'):
+      self.assertRaises(snappy_pure.ErrorCorrupt, snappy_pure.uvarint_batch, buf)
+
+
+class TestCRC(unittest.TestCase):
+
+  def testSliced(self):
+    engine = snappy_pure.CRC32(0x82F63B78)
+    engine.native = None
+    data = randBytes(1000)
+    for n in (0, 1, 7, 8, 9, 15, 16, 17, 1000):
+      want = 0xffffffff
+      for c in data[:n]:
+        want = (want >> 8) ^ engine.table[(want ^ c) & 0xff]
+      want ^= 0xffffffff
+      got = engine.Update(data[:n])
+      if got != want:
+        raise AssertionError('len %d: got %#x, want %#x' % (n, got, want))
+    self.assertEqual(engine.Update(b'123456789'), 0xe3069283)
+    self.assertEqual(snappy_pure.castagnoli.Update(data), engine.Update(data))
+
 
 if __name__ == '__main__':
   unittest.main()